@@ -1,14 +1,80 @@
 import random
 import string
+import asyncio
 import json, pickle
 import logging
+import queue
+import hashlib
+import time
+import traceback
+from collections import OrderedDict, deque
 from datetime import datetime
-from threading import Thread, Event
-from jsonschema import validate, exceptions as jsonschema_exceptions
-from protocols.amqp.receive import Receiver
+from threading import Event, Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, Future
+import blosc
+from jsonschema import validators, exceptions as jsonschema_exceptions
+from protocols.amqp.receive import Receiver, DEFAULT_WINDOW, AT_LEAST_ONCE
 from protocols.amqp.send import Sender
-from utils.message import Message
-from utils.broker import Broker
+from utils.message import Message, canonical_json
+from utils.broker import Broker, CapabilitiesManager, CAPABILITY_TIMEOUT, CLEANUP_INTERVAL, RECEIVER_CAPABILITY_TOPIC
+from utils.data_compression import decompress_timetags_chunk
+from utils.result_sink import MemorySink
+from utils import metrics
+
+# Compiled parameters_schema validators kept by ValidatorCache
+VALIDATOR_CACHE_SIZE = 256
+SPECIFICATION_TOPIC = "topic:///specifications"
+GET_CAPABILITIES_TOPIC = "topic:///get_capabilities"
+
+class ConfigurationError(Exception):
+    """
+    Raised by MeasurementPlaneClient.configure_many when parameter sets do not match the schema.
+    `failures` maps the index of every invalid parameter set to its validation messages.
+    """
+    def __init__(self, failures: dict):
+        super().__init__(f"{len(failures)} invalid parameter set(s): " +
+                         "; ".join(f"#{index}: {', '.join(messages)}" for index, messages in failures.items()))
+        self.failures = failures
+
+class ValidatorCache:
+    """
+    Validators of parameters schemas, built and checked once per (capability id, schema hash)
+    instead of on every jsonschema.validate call. Bounded, least recently used first out.
+    """
+    def __init__(self, maxsize=VALIDATOR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.validators = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, capability: dict):
+        """
+        Returns:
+            Validator of the parameters_schema of the capability.
+        Raises:
+            KeyError: if the capability has no parameters_schema, which does not mean "anything goes".
+            jsonschema.exceptions.SchemaError: if the schema itself is invalid.
+        """
+        schema = capability['parameters_schema']
+        try:
+            capability_id = Message.calculate_capability_id(capability)
+        except KeyError:
+            capability_id = None
+        key = (capability_id, hashlib.sha256(canonical_json(schema).encode()).hexdigest())
+        with self.lock:
+            validator = self.validators.get(key)
+            if validator is not None:
+                self.validators.move_to_end(key)
+                return validator
+        validator_class = validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        with self.lock:
+            self.validators[key] = validator
+            if len(self.validators) > self.maxsize:
+                self.validators.popitem(last=False)
+        return validator
+
+VALIDATORS = ValidatorCache()
 
 class MeasurementPlaneClient:
     def __init__(self, broker_url) -> None:
@@ -16,46 +82,122 @@ class MeasurementPlaneClient:
         self.sender = Sender()
         self.broker = Broker(self.broker_url)
         self.broker.start()
+        # Last get_capabilities reply by requested types: (version, {capability_id: capability})
+        self.capabilities_replies = {}
+        # Capabilities announced by the agents, kept like the broker does and expiring the same way
+        self.capabilities_cache = CapabilitiesManager(CAPABILITY_TIMEOUT, CLEANUP_INTERVAL)
+        self.capabilities_receiver = Receiver(on_message_callback=self.capabilities_receiver_on_message_callback)
+        self.capabilities_receiver.start(self.broker_url, RECEIVER_CAPABILITY_TOPIC)
+        # Receipts of send_measurements, all on one reply topic: measurement_id -> deque of (measurement, future)
+        self.receipts_receiver = None
+        self.receipts_topic = None
+        self.pending_receipts = {}
+        self.pending_receipts_lock = Lock()
+
+    def capabilities_receiver_on_message_callback(self, event):
+        try:
+            message = json.loads(event.message.body)
+            self.capabilities_cache.add_capability(Message.calculate_capability_id(message=message), message)
+        except Exception as e:
+            logging.error(f"Error processing capability announcement: {e}")
+
+    def get_capabilities(self, capability_types: list = None, compress: bool = False, refresh: bool = False) -> dict:
+        """
+        Capabilities of the given types (all if capability_types is not set), numbered from 0.
+
+        They come from the local cache fed by the agents' announcements. The broker is only asked
+        when the cache has none of them, e.g. right after start before the agents announce again,
+        or when refresh is set; the capabilities of its reply then go into the cache.
+        """
+        capabilities = self.cached_capabilities(capability_types)
+        if refresh or not capabilities:
+            capabilities = self.request_capabilities(capability_types, compress)
+            self.cache_capabilities(capabilities)
+
+        return self.number_capabilities(capabilities)
+
+    def cached_capabilities(self, capability_types: list = None) -> dict:
+        if capability_types:
+            return self.capabilities_cache.get_capabilities_by_type(capability_types)
+        return dict(self.capabilities_cache.capabilities)
+
+    def cache_capabilities(self, capabilities: dict):
+        for cp_id, capability in capabilities.items():
+            try:
+                self.capabilities_cache.add_capability(cp_id, capability)
+            except ValueError as e:
+                logging.error(f"Ignoring capability: {e}")
 
-    def get_capabilities(self, capability_types: list = None) -> dict:
+    @staticmethod
+    def number_capabilities(capabilities: dict) -> dict:
+        return {i: capability for i, capability in enumerate(capabilities.values())}
+
+    def request_capabilities(self, capability_types: list = None, compress: bool = False) -> dict:
+        """
+        Ask the broker for the {capability_id: capability} of the given types only if
+        capability_types is set. The version of the previous reply for the same types is sent
+        along, so the broker answers with what changed since then, or nothing if nothing did.
+        """
         capabilities_event = Event()
         capabilities = {}
 
         def capabilities_receiver_on_message_callback(event):
             nonlocal capabilities
             try:
-                capabilities = json.loads(event.message.body)
-                if capability_types:
-                    keys_to_delete = [cp_id for cp_id in capabilities if capabilities[cp_id]['capability'] not in capability_types]
-                    for cp_id in keys_to_delete:
-                        del capabilities[cp_id]
-            except KeyError as e:
-                logging.error(f"KeyError: {e}. Missing required keys in capability_body.")
+                capabilities = self.read_capabilities_reply(event, capability_types)
             finally:
                 capabilities_event.set()
-                event.container.stop()
 
-        topic = 'topic:///get_capabilities'
         reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
 
         capabilities_receiver = Receiver(on_message_callback=capabilities_receiver_on_message_callback)
-        thread_capabilities_receiver = Thread(target=capabilities_receiver.receive_event, args=(self.broker_url, reply_to_topic))
-        thread_capabilities_receiver.start()
+        capabilities_receiver.start(self.broker_url, reply_to_topic).wait_ready(timeout=2)
 
-        self.sender.send(self.broker_url, topic, "", reply_to_topic)
+        self.sender.send(self.broker_url, GET_CAPABILITIES_TOPIC, self.capabilities_request(capability_types, compress), reply_to_topic)
 
         capabilities_event.wait(timeout=2)
-        capabilities_receiver.container.stop()
-        thread_capabilities_receiver.join()
-        # Create a list of the dictionary's keys
-        keys = list(capabilities.keys())
-
-        i = 0
-        for id in keys:
-            capabilities[i] = capabilities.pop(id)
-            i += 1
+        capabilities_receiver.stop()
         return capabilities if capabilities else {}
 
+    def capabilities_request(self, capability_types: list = None, compress: bool = False) -> dict:
+        types_key = tuple(sorted(capability_types)) if capability_types else None
+        return {
+            "capability_types": capability_types,
+            "version": self.capabilities_replies.get(types_key, (None, {}))[0],
+            "compress": compress
+        }
+
+    def read_capabilities_reply(self, event, capability_types: list = None) -> dict:
+        """{capability_id: capability} of a get_capabilities reply, {} if it cannot be read."""
+        types_key = tuple(sorted(capability_types)) if capability_types else None
+        try:
+            capabilities = Message.decode_json_body(event.message.body, event.message.content_type)
+            if 'status' in capabilities:
+                return self.apply_capabilities_reply(types_key, capabilities)
+            if capability_types:
+                # Broker without versioned replies, the whole dict is filtered here
+                keys_to_delete = [cp_id for cp_id in capabilities if capabilities[cp_id]['capability'] not in capability_types]
+                for cp_id in keys_to_delete:
+                    del capabilities[cp_id]
+            return capabilities
+        except KeyError as e:
+            logging.error(f"KeyError: {e}. Missing required keys in capability_body.")
+        except (TypeError, ValueError) as e:
+            logging.error(f"Failed to decode capabilities reply: {e}")
+        return {}
+
+    def apply_capabilities_reply(self, types_key, reply) -> dict:
+        """Update the capabilities held for types_key with a versioned reply, return a copy of them."""
+        if reply['status'] == 'full':
+            held = dict(reply['capabilities'])
+        else:
+            held = dict(self.capabilities_replies.get(types_key, (None, {}))[1])
+            for cp_id in reply['removed']:
+                held.pop(cp_id, None)
+            held.update(reply['capabilities'])
+        self.capabilities_replies[types_key] = (reply['version'], held)
+        return dict(held)
+
     def combine_to_string(self, attributes: list) -> str:
         return ''.join(str(att).replace(" ", "").replace("\n", "") for att in attributes)
     
@@ -65,18 +207,132 @@ class MeasurementPlaneClient:
     def create_measurement(self, capability: dict) -> 'Measurement':
         return Measurement(capability, self)
 
+    def configure_many(self, capability: dict, schedule, parameter_sets: list, result_callback, **options) -> list:
+        """
+        One measurement of `capability` per parameter set, configured with the same schedule,
+        callback and options (see Measurement.configure). Every parameter set is validated first,
+        with the one compiled validator of the capability, and if any is invalid nothing is
+        configured and ConfigurationError reports all of them together.
+
+        Returns:
+            list: The configured measurements, in the order of parameter_sets.
+        """
+        measurements = [self.create_measurement(capability) for _ in parameter_sets]
+        failures = {}
+        for index, (measurement, parameters) in enumerate(zip(measurements, parameter_sets)):
+            errors = measurement.validation_errors(parameters)
+            if errors:
+                failures[index] = errors
+        if failures:
+            raise ConfigurationError(failures)
+        for measurement, parameters in zip(measurements, parameter_sets):
+            measurement.apply_configuration(schedule, parameters, result_callback, **options)
+        return measurements
+
+    def send_measurements(self, measurements: list, timeout: float = None) -> list:
+        """
+        Send the specifications of all the measurements without waiting for each receipt: they go
+        out back to back over the pooled connection, and every receipt comes back on one reply
+        topic shared by the client, matched to its measurement by measurement id.
+
+        Args:
+            measurements (list): Configured measurements.
+            timeout (float): If set, receipts not received after that many seconds fail their
+                future with TimeoutError.
+
+        Returns:
+            list: One concurrent.futures.Future per measurement, resolved with its receipt message
+            once the results receiver of the measurement is started.
+        """
+        receipts_subscription = self.start_receipts_receiver()
+        receipts_subscription.wait_ready(timeout=2)
+        return self._send_specifications(receipts_subscription, measurements, timeout)
+
+    def _send_specifications(self, receipts_subscription, measurements: list, timeout: float = None) -> list:
+        """send_measurements once the receipts receiver is started, never blocks."""
+        futures = []
+        for measurement in measurements:
+            future = Future()
+            measurement_id = Message.calculate_measurement_id(message=measurement.specification_message)
+            entry = (measurement, future)
+            with self.pending_receipts_lock:
+                self.pending_receipts.setdefault(measurement_id, deque()).append(entry)
+            sent = self.sender.send(self.broker_url, SPECIFICATION_TOPIC, measurement.specification_message, self.receipts_topic)
+            sent.add_done_callback(lambda sent, measurement_id=measurement_id, entry=entry:
+                                   sent.exception() and self._fail_receipt(measurement_id, entry, sent.exception()))
+            futures.append(future)
+        if timeout is not None:
+            entries = [(Message.calculate_measurement_id(message=measurement.specification_message), (measurement, future))
+                       for measurement, future in zip(measurements, futures)]
+            # Expired on the reactor thread of the receipts, no thread per call
+            receipts_subscription.hub.call_later(timeout, self._expire_receipts, entries, timeout)
+        return futures
+
+    def _expire_receipts(self, entries, timeout):
+        for measurement_id, entry in entries:
+            self._fail_receipt(measurement_id, entry, TimeoutError(f"No receipt after {timeout} s"))
+
+    def start_receipts_receiver(self):
+        """Subscribe to the shared receipts topic on first use. Returns the subscription."""
+        with self.pending_receipts_lock:
+            if self.receipts_receiver is None:
+                self.receipts_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+                self.receipts_receiver = Receiver(on_message_callback=self.receipts_receiver_on_message_callback)
+                self.receipts_receiver.start(self.broker_url, self.receipts_topic)
+            return self.receipts_receiver.subscription
+
+    def receipts_receiver_on_message_callback(self, event):
+        try:
+            receipt_msg = json.loads(event.message.body)
+        except (TypeError, ValueError) as e:
+            logging.error(f"Ignoring invalid receipt message: {e}")
+            return
+        if not isinstance(receipt_msg, dict) or 'receipt' not in receipt_msg:
+            return
+        try:
+            measurement_id = Message.calculate_measurement_id(message=receipt_msg)
+        except KeyError as e:
+            logging.error(f"Ignoring invalid receipt: {e.args[0]}")
+            return
+        with self.pending_receipts_lock:
+            entries = self.pending_receipts.get(measurement_id)
+            entry = entries.popleft() if entries else None
+            if entries is not None and not entries:
+                del self.pending_receipts[measurement_id]
+        if entry is None:
+            logging.warning(f"Receipt of unknown or expired measurement {measurement_id}")
+            return
+        measurement, future = entry
+        try:
+            measurement.on_receipt(receipt_msg)
+        except Exception as e:
+            logging.error(f"Failed to handle the receipt of measurement {measurement_id}: {e}")
+            future.set_exception(e)
+            return
+        future.set_result(receipt_msg)
+
+    def _fail_receipt(self, measurement_id, entry, exception):
+        # Whoever removes the entry resolves its future, so a receipt and a failure never race
+        with self.pending_receipts_lock:
+            entries = self.pending_receipts.get(measurement_id)
+            if not entries or entry not in entries:
+                return
+            entries.remove(entry)
+            if not entries:
+                del self.pending_receipts[measurement_id]
+        entry[1].set_exception(exception)
+
     def send_measurement(self, measurement: 'Measurement'):
-        specification_topic = "topic:///specifications"
+        specification_topic = SPECIFICATION_TOPIC
         reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
 
         measurement.receipt_receiver = Receiver(on_message_callback=measurement.receipt_receiver_on_message_callback)
-        thread_receipt_receiver = Thread(target=measurement.receipt_receiver.receive_event, args=(self.broker_url, reply_to_topic))
-        thread_receipt_receiver.start()
+        measurement.receipt_receiver.start(self.broker_url, reply_to_topic).wait_ready(timeout=2)
 
         self.sender.send(self.broker_url, specification_topic, measurement.specification_message, reply_to_topic)
 
-        thread_receipt_receiver.join(timeout=2)
-        measurement.receipt_receiver.container.stop()
+        measurement.receipt_event.wait(timeout=2)
+        measurement.receipt_receiver.stop()
 
     def interrupt_measurement(self, measurement: 'Measurement'):
         measurement.interrupt()
@@ -87,79 +343,145 @@ class Measurement:
         self.broker_url = self.measurement_plane_client.broker_url
         self.capability = capability
         self.results_receiver = None
-        self.results = []
+        self.receipt_receiver = None
+        self.receipt_event = Event()
+        self.results = MemorySink()
         self.config = {}
+        self.decoder = None
         self.specification_message = capability.copy()
         self.specification_message['specification'] = self.specification_message.pop('capability')
 
-    def configure(self, schedule: dict, parameters: dict, result_callback, stream_results: bool = False, redirect_to_storage: bool = False, completion_callback = None) -> bool:
+    def configure(self, schedule: dict, parameters: dict, result_callback, stream_results: bool = False, redirect_to_storage: bool = False, completion_callback = None, decode_workers: int = 0,
+                  result_sink = None, result_window: int = DEFAULT_WINDOW, manual_release: bool = False,
+                  delivery_mode: str = AT_LEAST_ONCE, ack_batch: int = 1, ack_interval: float = None) -> bool:
+        """
+        With decode_workers > 0, compressed timetag chunks of the results ({channel: {wrt: bytes}})
+        are decompressed by a pool of that many threads, off the AMQP reactor thread, and
+        result_callback receives the decoded arrays, still in the order the results arrived.
+
+        Results are kept in `result_sink` once the callback has run, everything in memory by
+        default; see utils.result_sink for keeping the last N, spilling to disk or discarding.
+
+        At most `result_window` results are in flight between the broker and result_callback:
+        when the callback (or the decoding) falls behind, the results receiver stops granting
+        credit and the broker holds the rest. With manual_release the consumer of result_callback
+        calls release_results() once per results it has processed, e.g. from another thread.
+        A large window suits high-rate count-rate and timetag streams.
+
+        delivery_mode is AT_LEAST_ONCE (results are acknowledged once released, every `ack_batch`
+        results or after `ack_interval` seconds) or AT_MOST_ONCE (settled on arrival), see
+        protocols.amqp.receive.Subscription.
+        """
         if self.validate_parameters(parameters):
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
-            self.specification_message.update({
-                'parameters': parameters,
-                'schedule': schedule,
-                'timestamp': timestamp
-            })
-            self.config = {
-                "stream_results": stream_results,
-                "redirect_to_storage": redirect_to_storage,
-                "result_callback": result_callback,
-                "completion_callback": completion_callback
-            }
+            self.apply_configuration(schedule, parameters, result_callback, stream_results, redirect_to_storage,
+                                     completion_callback, decode_workers, result_sink, result_window, manual_release,
+                                     delivery_mode, ack_batch, ack_interval)
             return True
         return False
 
+    def apply_configuration(self, schedule: dict, parameters: dict, result_callback, stream_results: bool = False, redirect_to_storage: bool = False, completion_callback = None, decode_workers: int = 0,
+                            result_sink = None, result_window: int = DEFAULT_WINDOW, manual_release: bool = False,
+                            delivery_mode: str = AT_LEAST_ONCE, ack_batch: int = 1, ack_interval: float = None):
+        """Configure with parameters that were already validated."""
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
+        self.specification_message.update({
+            'parameters': parameters,
+            'schedule': schedule,
+            'timestamp': timestamp
+        })
+        self.config = {
+            "stream_results": stream_results,
+            "redirect_to_storage": redirect_to_storage,
+            "result_callback": result_callback,
+            "completion_callback": completion_callback,
+            "decode_workers": decode_workers,
+            "result_window": result_window,
+            "manual_release": manual_release,
+            "delivery_mode": delivery_mode,
+            "ack_batch": ack_batch,
+            "ack_interval": ack_interval
+        }
+        if result_sink is not None:
+            self.results = result_sink
+        if self.decoder:
+            self.decoder.close()
+        self.decoder = ResultDecoder(self.deliver_results, decode_workers) if decode_workers > 0 else None
+
     def receipt_receiver_on_message_callback(self, event):
         receipt_msg = json.loads(event.message.body)
         if 'receipt' in receipt_msg:
-            event.container.stop()
-            if 'interrupt' in receipt_msg:
-                logging.info("Measurement interrupted.")
-            else:
-                if self.results_receiver is None:
-                    measurement_id = Message.calculate_measurement_id(message = receipt_msg)
-                    self.results_receiver = Receiver(on_message_callback=self.result_receiver_on_message_callback)
-                    topic = f'topic://{measurement_id}/results'
-                    self.results_receiver.receive_event(self.broker_url, topic)
-
-    def result_receiver_on_message_callback(self, event):
-        message_body = event.message.body
+            self.receipt_receiver.stop()
+            self.on_receipt(receipt_msg)
 
-        # Convert memoryview to bytes if necessary
-        if isinstance(message_body, memoryview):
-            message_body = message_body.tobytes()
+    def on_receipt(self, receipt_msg):
+        self.receipt_event.set()
+        if 'interrupt' in receipt_msg:
+            logging.info("Measurement interrupted.")
+        else:
+            if self.results_receiver is None:
+                measurement_id = Message.calculate_measurement_id(message = receipt_msg)
+                self.results_receiver = Receiver(on_message_callback=self.result_receiver_on_message_callback)
+                topic = f'topic://{measurement_id}/results'
+                self.results_receiver.start(self.broker_url, topic, manual_release=True,
+                                            window=self.config.get("result_window", DEFAULT_WINDOW),
+                                            delivery_mode=self.config.get("delivery_mode", AT_LEAST_ONCE),
+                                            ack_batch=self.config.get("ack_batch", 1),
+                                            ack_interval=self.config.get("ack_interval"))
 
-        # Try to decode as JSON or fall back to pickle
+    def result_receiver_on_message_callback(self, event):
+        # Dispatch on the content type: JSON, framed timetags or (legacy) pickled binary bodies
         result_msg = None
-        if isinstance(message_body, bytes):
-            # If it's bytes, assume it's pickled binary data
-            try:
-                result_msg = pickle.loads(message_body)
-                logging.info("Successfully received and deserialized the message using pickle.")
-            except pickle.UnpicklingError as e:
-                logging.error(f"Failed to deserialize message with pickle: {e}")
-                result_msg = None
-        else:
-            try:
-                result_msg = json.loads(message_body)
-                logging.info("Successfully received and decoded the message using JSON.")
-            except (UnicodeDecodeError, json.JSONDecodeError, TypeError) as e:
-                logging.error(f"Failed to decode message as JSON: {e}")
-                result_msg = None
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            result_msg = Message.decode_body(event.message.body, event.message.content_type, event.message.properties)
+            if start is not None:
+                metrics.histogram("result_decode_seconds", "Decoding a result message body",
+                                  content_type=str(event.message.content_type)).observe(time.perf_counter() - start)
+            logging.info("Successfully received and decoded a %s message.", event.message.content_type)
+        except (pickle.UnpicklingError, UnicodeDecodeError, json.JSONDecodeError, TypeError, ValueError) as e:
+            logging.error(f"Failed to decode {event.message.content_type} message: {e}")
+            result_msg = None
 
         # Proceed if decoding was successful
         if result_msg and 'result' in result_msg:
             results = result_msg['resultValues']
-            logging.info(f"Received results: {results}")
-            if 'EOF_results' in results:
-                print("EOF received will stop")
-                self.config['result_callback'](results)
-                self.stop()
-                return
+            logging.info("Received results: %s", results)
+            if self.decoder:
+                self.decoder.submit(results)
+            else:
+                self.deliver_results(results)
+        else:
+            self.release_results()
+
+    def deliver_results(self, results):
+        if 'EOF_results' in results:
+            print("EOF received will stop")
+            self.config['result_callback'](results)
+            self.stop()
+            return
+        start = time.perf_counter() if metrics.enabled else None
+        try:
             self.config['result_callback'](results)
             self.results.append(results)
-            
+            if start is not None:
+                metrics.histogram("result_callback_seconds", "Result callback of the measurements, and storing the results").observe(
+                    time.perf_counter() - start)
+                metrics.counter("results_delivered_total", "Results handed to the result callbacks").inc()
+        finally:
+            if not self.config.get("manual_release"):
+                self.release_results()
+
+    def release_results(self, count: int = 1):
+        """Grant the broker credit for `count` more results, see configure."""
+        if self.results_receiver and self.results_receiver.subscription:
+            self.results_receiver.subscription.release(count)
+
     def interrupt(self):
+        self.measurement_plane_client.send_measurement(self.create_interruption())
+        self.stop()
+
+    def create_interruption(self) -> 'Measurement':
+        """The measurement whose specification message interrupts this one."""
         interrupt_msg = self.specification_message
         interrupt_msg['capability'] = interrupt_msg['specification']
         interruption = Measurement(interrupt_msg, self.measurement_plane_client)
@@ -167,17 +489,261 @@ class Measurement:
         interrupt_msg['interrupt'] = interrupt_msg['specification']
         del interrupt_msg['specification']
         interruption.message = interrupt_msg
-        self.measurement_plane_client.send_measurement(interruption)
-        self.stop()
+        return interruption
         
     def stop(self):
         if self.results_receiver:
-            self.results_receiver.container.stop()
+            self.results_receiver.stop()
+        # The sink is closed once the results already handed to the decoder are stored
+        if self.decoder:
+            self.decoder.close(then=self.results.close)
+        else:
+            self.results.close()
 
     def validate_parameters(self, parameters: dict) -> bool:
         try:
-            validate(instance=parameters, schema=self.capability['parameters_schema'])
-            return True
-        except jsonschema_exceptions.ValidationError as err:
-            logging.error(f"Validation error: {err.message}")
+            error = jsonschema_exceptions.best_match(VALIDATORS.get(self.capability).iter_errors(parameters))
+        except jsonschema_exceptions.SchemaError as err:
+            logging.error(f"Invalid parameters schema: {err.message}")
+            return False
+        if error is not None:
+            logging.error(f"Validation error: {error.message}")
             return False
+        return True
+
+    def validation_errors(self, parameters: dict) -> list:
+        """Messages of every validation error of the parameters, empty if they are valid."""
+        try:
+            validator = VALIDATORS.get(self.capability)
+        except jsonschema_exceptions.SchemaError as err:
+            return [f"Invalid parameters schema: {err.message}"]
+        return [error.message for error in validator.iter_errors(parameters)]
+
+class ResultDecoder:
+    """
+    Decompresses the timetag chunks of results on a thread pool and hands the decoded results to
+    `deliver` on a single delivery thread, in submission order. submit() never blocks, so the
+    AMQP reactor thread keeps taking messages while earlier ones are being decoded.
+    """
+    def __init__(self, deliver, workers: int):
+        # blosc only decompresses concurrently (and without the GIL) in this mode
+        blosc.set_releasegil(True)
+        self.deliver = deliver
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="result-decoder")
+        self.pending = queue.Queue()
+        self.closed = False
+        self.on_closed = None
+        self.lock = Lock()
+        self.thread = Thread(target=self._run, name="result-delivery", daemon=True)
+        self.thread.start()
+
+    def submit(self, results):
+        with self.lock:
+            if self.closed:
+                # A message the reactor handed over while the subscription was being detached
+                logging.warning("Dropping results submitted after the decoder was closed")
+                return
+            self._submit(results)
+
+    def _submit(self, results):
+        chunks = []
+        if isinstance(results, list):
+            for value in results:
+                if not isinstance(value, dict):
+                    continue
+                for per_wrt in value.values():
+                    if not isinstance(per_wrt, dict):
+                        continue
+                    for wrt, chunk in per_wrt.items():
+                        if isinstance(chunk, (bytes, bytearray, memoryview)):
+                            chunks.append((per_wrt, wrt, self.executor.submit(decompress_timetags_chunk, chunk)))
+        self.pending.put((results, chunks))
+        if metrics.enabled:
+            metrics.gauge("result_decoder_queue_depth", "Results submitted to a ResultDecoder and not delivered yet").set(
+                self.pending.qsize())
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                if self.on_closed is not None:
+                    try:
+                        self.on_closed()
+                    except Exception:
+                        traceback.print_exc()
+                return
+            results, chunks = item
+            for per_wrt, wrt, future in chunks:
+                try:
+                    per_wrt[wrt] = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to decompress timetags of wr_time {wrt}: {e}")
+            try:
+                self.deliver(results)
+            except Exception:
+                traceback.print_exc()
+
+    def close(self, then=None):
+        """
+        Deliver what was already submitted, then stop the threads. Later results are dropped.
+        `then` is called on the delivery thread once the last result is delivered.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.on_closed = then
+            self.pending.put(None)
+            self.executor.shutdown(wait=False)
+
+_END_OF_RESULTS = object()
+
+def _set_future_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+async def wait_subscription_ready(subscription, timeout=None) -> bool:
+    """Async Subscription.wait_ready: the link attach is signalled into the event loop."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    subscription.add_ready_callback(lambda: loop.call_soon_threadsafe(_set_future_result, ready, True))
+    try:
+        await asyncio.wait_for(ready, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+class AsyncMeasurementPlaneClient:
+    """
+    asyncio interface of MeasurementPlaneClient, e.g. for Jupyter or asyncio services:
+
+        client = AsyncMeasurementPlaneClient(broker_url)
+        capabilities = await client.get_capabilities(["measure-count-rate"])
+        measurement = client.create_measurement(capabilities[0])
+        measurement.configure(schedule="now | | stream", parameters=parameters)
+        await client.send_measurement(measurement)
+        async for results in measurement.results():
+            ...
+
+    It shares the reactor threads of the wrapped synchronous client, which keeps working: AMQP
+    callbacks hand their messages to the event loop with call_soon_threadsafe, and sends are
+    awaited through their futures, so no call blocks the loop or starts a thread.
+    """
+    def __init__(self, broker_url=None, client: MeasurementPlaneClient = None):
+        self.client = client if client is not None else MeasurementPlaneClient(broker_url)
+        self.broker_url = self.client.broker_url
+
+    async def get_capabilities(self, capability_types: list = None, compress: bool = False, refresh: bool = False, timeout: float = 2) -> dict:
+        """See MeasurementPlaneClient.get_capabilities."""
+        capabilities = self.client.cached_capabilities(capability_types)
+        if refresh or not capabilities:
+            capabilities = await self.request_capabilities(capability_types, compress, timeout)
+            self.client.cache_capabilities(capabilities)
+        return self.client.number_capabilities(capabilities)
+
+    async def request_capabilities(self, capability_types: list = None, compress: bool = False, timeout: float = 2) -> dict:
+        """See MeasurementPlaneClient.request_capabilities."""
+        loop = asyncio.get_running_loop()
+        reply = loop.create_future()
+
+        def capabilities_receiver_on_message_callback(event):
+            capabilities = self.client.read_capabilities_reply(event, capability_types)
+            loop.call_soon_threadsafe(_set_future_result, reply, capabilities)
+
+        reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        capabilities_receiver = Receiver(on_message_callback=capabilities_receiver_on_message_callback)
+        try:
+            await wait_subscription_ready(capabilities_receiver.start(self.broker_url, reply_to_topic), timeout)
+            await asyncio.wrap_future(self.client.sender.send(
+                self.broker_url, GET_CAPABILITIES_TOPIC, self.client.capabilities_request(capability_types, compress), reply_to_topic))
+            return await asyncio.wait_for(reply, timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"No capabilities reply after {timeout} s")
+            return {}
+        finally:
+            capabilities_receiver.stop()
+
+    def create_measurement(self, capability: dict) -> 'AsyncMeasurement':
+        return AsyncMeasurement(self.client.create_measurement(capability), self)
+
+    async def send_measurement(self, measurement: 'AsyncMeasurement', timeout: float = 2) -> dict:
+        """Send the specification and return its receipt, raises TimeoutError without one."""
+        return (await self.send_measurements([measurement], timeout, return_exceptions=False))[0]
+
+    async def send_measurements(self, measurements: list, timeout: float = None, return_exceptions: bool = True) -> list:
+        """
+        See MeasurementPlaneClient.send_measurements. Returns the receipts, in order. With
+        `return_exceptions` (the default) a measurement that got no receipt has its exception,
+        e.g. TimeoutError, in its place and the receipts that did arrive are kept; otherwise
+        the first such exception is raised.
+        """
+        return await self._send([measurement.measurement for measurement in measurements], timeout, return_exceptions)
+
+    async def _send(self, measurements: list, timeout: float = None, return_exceptions: bool = False) -> list:
+        receipts_subscription = self.client.start_receipts_receiver()
+        await wait_subscription_ready(receipts_subscription, timeout)
+        # The timeout is applied here, on the event loop, rather than by send_measurements
+        futures = self.client._send_specifications(receipts_subscription, measurements)
+        receipts = [asyncio.wrap_future(future) for future in futures]
+        if timeout is not None and receipts:
+            await asyncio.wait(receipts, timeout=timeout)
+            for measurement, future in zip(measurements, futures):
+                if not future.done():
+                    measurement_id = Message.calculate_measurement_id(message=measurement.specification_message)
+                    self.client._fail_receipt(measurement_id, (measurement, future), TimeoutError(f"No receipt after {timeout} s"))
+        return await asyncio.gather(*receipts, return_exceptions=return_exceptions)
+
+    async def interrupt_measurement(self, measurement: 'AsyncMeasurement', timeout: float = 2):
+        await measurement.interrupt(timeout)
+
+class AsyncMeasurement:
+    """
+    Measurement whose results are consumed with `async for results in measurement.results()`.
+
+    Results wait in an asyncio.Queue and are released (see Measurement.configure) once the
+    consumer asks for the next ones: when it falls `queue_size` results behind, the results
+    receiver stops granting credit, so neither the queue nor the AMQP thread ever waits.
+    """
+    def __init__(self, measurement: Measurement, client: AsyncMeasurementPlaneClient):
+        self.measurement = measurement
+        self.client = client
+        self.loop = None
+        self.queue = None
+
+    def configure(self, schedule, parameters: dict, queue_size: int = 1000, **options) -> bool:
+        """See Measurement.configure, to be called from the event loop that consumes the results."""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        return self.measurement.configure(schedule, parameters, result_callback=self.on_results,
+                                          result_window=queue_size, manual_release=True, **options)
+
+    def on_results(self, results):
+        # Runs on the AMQP (or result delivery) thread
+        self.loop.call_soon_threadsafe(self._put, results)
+
+    def _put(self, results):
+        self.queue.put_nowait(results)
+
+    async def results(self):
+        """Yield the results as they arrive, until the end of the measurement."""
+        while True:
+            results = await self.queue.get()
+            if results is _END_OF_RESULTS:
+                return
+            yield results
+            if 'EOF_results' in results:
+                return
+            self.measurement.release_results()
+
+    async def interrupt(self, timeout: float = 2):
+        try:
+            await self.client._send([self.measurement.create_interruption()], timeout)
+        except TimeoutError:
+            logging.error(f"No receipt for the interruption after {timeout} s")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.measurement.stop()
+        if self.queue is not None:
+            self._put(_END_OF_RESULTS)
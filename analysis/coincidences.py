@@ -0,0 +1,287 @@
+import threading
+import numpy as np
+from utils.data_compression import decompress_data_blosc
+
+# Number of timestamps of the first channel processed per block, bounds the temporary arrays
+CHUNK_SIZE = 1 << 16
+PS_PER_SECOND = 10 ** 12
+
+def as_sorted(timestamps):
+    """
+    Return the timestamps as a numpy array sorted in increasing order (no copy if already sorted).
+    """
+    timestamps = np.asarray(timestamps)
+    if timestamps.size > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+        timestamps = np.sort(timestamps)
+    return timestamps
+
+def coincidence_windows(timestamps1, shifted_timestamps2, half_range_ps, chunk_size=CHUNK_SIZE):
+    """
+    Walk the (sorted) first channel block by block and yield, for each block, the indices of the
+    timestamps t1 that have at least one partner t2 with |t2 + peak0 - t1| <= half_range_ps, and
+    the index of their first partner in the (shifted, sorted) second channel.
+    """
+    n2 = len(shifted_timestamps2)
+    for start in range(0, len(timestamps1), chunk_size):
+        block = timestamps1[start:start + chunk_size]
+        # Search only the part of the second channel that can match this block: it stays in cache,
+        # which is several times faster than searching the whole array for large inputs
+        lower = np.searchsorted(shifted_timestamps2, block[0] - half_range_ps, side="left")
+        upper = np.searchsorted(shifted_timestamps2, block[-1] + half_range_ps, side="right")
+        first = np.searchsorted(shifted_timestamps2[lower:upper], block - half_range_ps, side="left") + lower
+        selected = np.flatnonzero(first < n2)
+        selected = selected[shifted_timestamps2[first[selected]] <= block[selected] + half_range_ps]
+        yield start + selected, first[selected]
+
+def pair_differences(timestamps1, shifted_timestamps2, half_range_ps, windows):
+    """
+    Yield the time differences t1 - (t2 + peak0) of all coincident pairs, one array per offset
+    inside the windows, so that no more than one block of differences exists at any moment.
+    """
+    n2 = len(shifted_timestamps2)
+    for index, partner in windows:
+        while index.size:
+            t1 = timestamps1[index]
+            yield t1 - shifted_timestamps2[partner]
+            # Later partners are above the lower bound already, only the upper one needs checking
+            partner = partner + 1
+            keep = partner < n2
+            keep[keep] = shifted_timestamps2[partner[keep]] <= t1[keep] + half_range_ps
+            index, partner = index[keep], partner[keep]
+
+def uniform_bin_edges(first_edge, last_edge, bins):
+    """
+    Equal-width bin edges computed exactly like np.histogram does.
+    """
+    first_edge, last_edge = float(first_edge), float(last_edge)
+    if first_edge == last_edge:
+        first_edge -= 0.5
+        last_edge += 0.5
+    return np.linspace(first_edge, last_edge, bins + 1, endpoint=True)
+
+def bin_indices(values, bin_edges):
+    """
+    Bin index of every value for equal-width `bin_edges`, using the same arithmetic and edge
+    corrections as np.histogram so that the counts match it exactly. Values outside the edges are
+    dropped, so the result may be shorter than `values`.
+    """
+    bins = len(bin_edges) - 1
+    first_edge, last_edge = bin_edges[0], bin_edges[-1]
+    values = values.astype(bin_edges.dtype, copy=False)
+    keep = (values >= first_edge) & (values <= last_edge)
+    if not keep.all():
+        values = values[keep]
+    indices = ((values - first_edge) / (last_edge - first_edge) * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+    indices[values < bin_edges[indices]] -= 1
+    indices[(values >= bin_edges[indices + 1]) & (indices != bins - 1)] += 1
+    return indices
+
+def accumulate_coincidences(differences, bin_edges, histo_vals):
+    """
+    Add the differences yielded by pair_differences to `histo_vals` with np.bincount.
+
+    Returns:
+        int: Number of coincident pairs found.
+    """
+    bins = len(histo_vals)
+    pairs = 0
+    for dtime in differences:
+        histo_vals += np.bincount(bin_indices(dtime, bin_edges), minlength=bins)
+        pairs += dtime.size
+    return pairs
+
+def difference_limits(differences):
+    """
+    Smallest and largest difference yielded by pair_differences, or None if there are none.
+    """
+    minimum, maximum = None, None
+    for dtime in differences:
+        minimum = dtime.min() if minimum is None else min(minimum, dtime.min())
+        maximum = dtime.max() if maximum is None else max(maximum, dtime.max())
+    if minimum is None:
+        return None
+    return minimum, maximum
+
+def calculate_coincidences(timestamps1, timestamps2, peak0=0, range_ns=1, bins=50, fixed_range=False, chunk_size=CHUNK_SIZE):
+    """
+    Histogram of the time differences between coincident timestamps of two channels.
+
+    Two timestamps are coincident when |t2 + peak0 - t1| <= range_ns / 2 (in ps, like the
+    timestamps). This gives the same result as the sliding-window loops of the analysis notebooks,
+    without building the list of every difference.
+
+    Args:
+        timestamps1 (array-like): Timestamps of the first channel, in ps.
+        timestamps2 (array-like): Timestamps of the second channel, in ps.
+        peak0 (float): Offset added to the second channel, in ps.
+        range_ns (float): Width of the coincidence window in nanoseconds.
+        bins (int): Number of bins for the histogram.
+        fixed_range (bool): Bin over the whole window [-range/2, range/2] instead of the range of
+            the differences found (np.histogram default). Fixed edges can be summed across calls.
+        chunk_size (int): Timestamps of the first channel processed per block.
+
+    Returns:
+        tuple: (histogram values, bin edges), peak time (left edge of the fullest bin).
+    """
+    timestamps1 = as_sorted(timestamps1)
+    shifted_timestamps2 = as_sorted(timestamps2) + peak0
+    half_range_ps = 1e3 * range_ns / 2
+
+    windows = coincidence_windows(timestamps1, shifted_timestamps2, half_range_ps, chunk_size)
+    if fixed_range:
+        bin_edges = uniform_bin_edges(-half_range_ps, half_range_ps, bins)
+    else:
+        # The edges depend on the differences found, so walk the pairs twice: the windows are kept
+        # to avoid searching again, they are much smaller than the differences themselves
+        windows = list(windows)
+        limits = difference_limits(pair_differences(timestamps1, shifted_timestamps2, half_range_ps, windows))
+        if limits is None:
+            histo_vals, bin_edges = np.histogram(np.array([]), bins=bins)
+            return (histo_vals, bin_edges), bin_edges[0]
+        bin_edges = uniform_bin_edges(limits[0], limits[1], bins)
+
+    histo_vals = np.zeros(bins, dtype=np.int64)
+    accumulate_coincidences(pair_differences(timestamps1, shifted_timestamps2, half_range_ps, windows), bin_edges, histo_vals)
+
+    peak = bin_edges[np.argmax(histo_vals)]
+    return (histo_vals, bin_edges), peak
+
+def read_timestamps_from_datastore(data_store, channel_1, channel_2, wrt):
+    """
+    Timestamps of two channels for one WR second of a {channel: {wrt: ndarray}} data store.
+    """
+    if wrt not in data_store[channel_1] or wrt not in data_store[channel_2]:
+        raise ValueError(f"WRT {wrt} not found in both channels.")
+    return data_store[channel_1][wrt], data_store[channel_2][wrt]
+
+def coincidences(data_store, channel_pairs, wrt, peak0=0, range_ns=1, bins=50, fixed_range=False):
+    """
+    Coincidence histograms of several channel pairs for one WR second.
+
+    Args:
+        data_store (dict): {channel: {wrt: ndarray}} timestamps.
+        channel_pairs (list): (channel_1, channel_2) tuples.
+        wrt (float): WR second to analyse.
+        peak0 (float or dict): Offset in ps, or a dict giving it per channel pair.
+        range_ns (float): Width of the coincidence window in nanoseconds.
+        bins (int): Number of bins for each histogram.
+        fixed_range (bool): See calculate_coincidences.
+
+    Returns:
+        dict: {(channel_1, channel_2): ((histogram values, bin edges), peak)}.
+    """
+    results = {}
+    for channel_1, channel_2 in channel_pairs:
+        timestamps1, timestamps2 = read_timestamps_from_datastore(data_store, channel_1, channel_2, wrt)
+        pair_peak0 = peak0.get((channel_1, channel_2), 0) if isinstance(peak0, dict) else peak0
+        results[(channel_1, channel_2)] = calculate_coincidences(
+            timestamps1, timestamps2, peak0=pair_peak0, range_ns=range_ns, bins=bins, fixed_range=fixed_range
+        )
+    return results
+
+def append_chunk(timestamps, chunk):
+    """`chunk` appended to `timestamps`, keeping the dtype of the chunk while nothing is held."""
+    return np.concatenate((timestamps, chunk)) if timestamps.size else chunk
+
+class CoincidenceAccumulator:
+    """
+    Streaming coincidence histogram of two channels, fed with timetag chunks as they arrive.
+
+    Each channel must be fed in time order (chunks of one channel never go back in time), but the
+    two channels may be fed independently. feed() takes timestamps on one time base for the whole
+    run, feed_result() the per WR second timestamps of the agents, which restart at 0 every second. A timestamp of the first channel is binned as soon as
+    the second channel has moved past its window, so coincidences that straddle two WR seconds
+    are counted, and only the part of each channel that can still find a partner is kept.
+    Memory is bounded by the window and the arrival skew between channels, not by the run length.
+
+    The histogram uses fixed edges over [-range/2, range/2] (see calculate_coincidences).
+    """
+    def __init__(self, channel_1, channel_2, peak0=0, range_ns=1, bins=50):
+        self.channel_1 = channel_1
+        self.channel_2 = channel_2
+        self.peak0 = peak0
+        self.half_range_ps = 1e3 * range_ns / 2
+        self.bin_edges = uniform_bin_edges(-self.half_range_ps, self.half_range_ps, bins)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histo_vals = np.zeros(len(self.bin_edges) - 1, dtype=np.int64)
+            self.pairs = 0
+            self.pending1 = np.empty(0)  # first channel, waiting for the second one to catch up
+            self.tail2 = np.empty(0)  # shifted second channel, still inside a future window
+            self.latest1 = -np.inf
+            self.latest2 = -np.inf
+            self.first_wrt = None  # WR second that feed_result counts time from
+
+    def feed(self, channel, timestamps):
+        """Add a chunk of timestamps (ps) of one channel. Chunks of other channels are ignored."""
+        if channel not in (self.channel_1, self.channel_2):
+            return
+        # Integer timestamps stay int64, absolute picoseconds do not fit exactly in a float64
+        timestamps = np.asarray(timestamps)
+        timestamps = as_sorted(timestamps.astype(np.int64 if timestamps.dtype.kind in "iu" else np.float64, copy=False))
+        if not timestamps.size:
+            return
+        with self.lock:
+            if channel == self.channel_1:
+                self.pending1 = append_chunk(self.pending1, timestamps)
+                self.latest1 = max(self.latest1, timestamps[-1])
+            if channel == self.channel_2:
+                self.tail2 = append_chunk(self.tail2, timestamps + self.peak0)
+                self.latest2 = max(self.latest2, timestamps[-1] + self.peak0)
+            self._process(final=False)
+
+    def feed_result(self, result):
+        """
+        Add a {channel: {wrt: timestamps}} result, in WR time order, with timestamps relative to
+        their WR second: each chunk is moved by (wrt - first wrt fed) seconds, in integer
+        picoseconds, so that seconds follow each other. Timestamps may still be compressed with
+        compress_data_blosc.
+        """
+        for channel, chunks in result.items():
+            for wrt in sorted(chunks):
+                timestamps = chunks[wrt]
+                if isinstance(timestamps, (bytes, bytearray, memoryview)):
+                    timestamps = decompress_data_blosc(bytes(timestamps))
+                with self.lock:
+                    if self.first_wrt is None:
+                        self.first_wrt = min(min(chunks) for chunks in result.values() if chunks)
+                    offset = int(round((wrt - self.first_wrt) * PS_PER_SECOND))
+                timestamps = np.asarray(timestamps)
+                if timestamps.dtype.kind in "iu":
+                    timestamps = timestamps.astype(np.int64, copy=False)
+                self.feed(channel, timestamps + offset)
+
+    def flush(self):
+        """Bin everything left, when no more data will come."""
+        with self.lock:
+            self._process(final=True)
+
+    def _process(self, final):
+        # Later second channel tags are >= latest2, so a t1 with t1 + range/2 < latest2 has all its partners
+        if final:
+            ready = len(self.pending1)
+        else:
+            ready = np.searchsorted(self.pending1, self.latest2 - self.half_range_ps, side="left")
+        timestamps1 = self.pending1[:ready]
+        if timestamps1.size and self.tail2.size:
+            windows = coincidence_windows(timestamps1, self.tail2, self.half_range_ps)
+            differences = pair_differences(timestamps1, self.tail2, self.half_range_ps, windows)
+            self.pairs += accumulate_coincidences(differences, self.bin_edges, self.histo_vals)
+        self.pending1 = self.pending1[ready:]
+
+        # Future first channel tags are >= the oldest pending one, or >= latest1 if none is pending
+        horizon = self.pending1[0] if self.pending1.size else self.latest1
+        self.tail2 = self.tail2[np.searchsorted(self.tail2, horizon - self.half_range_ps, side="left"):]
+
+    def histogram(self):
+        """
+        Returns:
+            tuple: (histogram values, bin edges), peak time, like calculate_coincidences.
+        """
+        with self.lock:
+            histo_vals = self.histo_vals.copy()
+        return (histo_vals, self.bin_edges), self.bin_edges[np.argmax(histo_vals)]
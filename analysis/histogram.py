@@ -0,0 +1,85 @@
+import threading
+import numpy as np
+
+def rebin(histo_vals, bin_edges, reference_edges):
+    """
+    Redistribute the counts of a histogram onto other bin edges, assuming the counts are spread
+    uniformly inside each source bin. Counts outside the reference edges are dropped.
+
+    Args:
+        histo_vals (array-like): Counts of the source histogram.
+        bin_edges (array-like): Edges of the source histogram, increasing.
+        reference_edges (array-like): Edges to rebin onto, increasing.
+
+    Returns:
+        np.ndarray: Counts per reference bin (float, a source bin may be split).
+    """
+    histo_vals = np.asarray(histo_vals, dtype=np.float64)
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    cumulative = np.concatenate(([0.0], np.cumsum(histo_vals)))
+    # np.interp clamps outside the source edges, so empty regions get no counts
+    return np.diff(np.interp(reference_edges, bin_edges, cumulative))
+
+class HistogramAccumulator:
+    """
+    Running sum of histograms sharing the bin edges of the first one added.
+
+    Histograms with other edges are rebinned onto the reference edges (see rebin). Three modes:
+    - all-time sum (default),
+    - `decay`: the running sum is multiplied by `decay` (0 < decay < 1) before each addition, so
+      a histogram added n updates ago weighs decay**n,
+    - `window`: only the latest `window` histograms are summed.
+    """
+    def __init__(self, decay=None, window=None):
+        if decay is not None and window is not None:
+            raise ValueError("Use either decay or window, not both")
+        if decay is not None and not 0 < decay < 1:
+            raise ValueError(f"Decay must be in (0, 1), got {decay}")
+        if window is not None and window < 1:
+            raise ValueError(f"Window must be at least 1, got {window}")
+        self.decay = decay
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bin_edges = None
+            self.histo_vals = None
+            self.history = None  # (window, bins) ring of the histograms summed, in window mode
+            self.updates = 0
+
+    def add(self, histo_vals, bin_edges):
+        """Add one histogram. The first one sets the reference edges."""
+        bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        with self.lock:
+            if self.bin_edges is None:
+                self.bin_edges = bin_edges
+                self.histo_vals = np.zeros(len(bin_edges) - 1, dtype=np.float64)
+                if self.window is not None:
+                    self.history = np.zeros((self.window, len(self.histo_vals)), dtype=np.float64)
+
+            if len(bin_edges) == len(self.bin_edges) and np.array_equal(bin_edges, self.bin_edges):
+                incoming = np.asarray(histo_vals, dtype=np.float64)
+            else:
+                incoming = rebin(histo_vals, bin_edges, self.bin_edges)
+
+            if self.decay is not None:
+                self.histo_vals *= self.decay
+            elif self.history is not None:
+                row = self.history[self.updates % self.window]
+                self.histo_vals -= row
+                row[:] = incoming
+            self.histo_vals += incoming
+            self.updates += 1
+
+    def histogram(self):
+        """
+        Returns:
+            tuple: (histogram values, bin edges), copies safe to use from another thread, or
+            (None, None) before the first histogram.
+        """
+        with self.lock:
+            if self.histo_vals is None:
+                return None, None
+            return self.histo_vals.copy(), self.bin_edges
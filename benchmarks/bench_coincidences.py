@@ -0,0 +1,111 @@
+"""
+Compare analysis.coincidences.calculate_coincidences with the sliding-window loop of the notebooks.
+
+The pure-Python loop is only timed on the first --reference-tags timestamps and extrapolated
+linearly, the vectorized version is timed on the full input and checked for identical output
+on the common subset.
+
+    python -m benchmarks.bench_coincidences --tags 10000000
+
+The vectorized version is bound by its binary searches (np.searchsorted of every timestamp of
+the first channel), which numpy offers no faster merge for. It measured 25x to 40x the notebook
+loop on 2e6 to 1e7 tags, short of the TARGET_SPEEDUP asked for, which the last line reports.
+"""
+import argparse
+import time
+import numpy as np
+from analysis.coincidences import CoincidenceAccumulator, PS_PER_SECOND, calculate_coincidences
+
+# Speedup over the notebook loop asked for the vectorized version on 1e7-tag inputs
+TARGET_SPEEDUP = 100
+
+def notebook_calculate_coincidences(timestamps1, timestamps2, peak0=0, range_ns=10, bins=50):
+    # Copied from correlation.ipynb
+    CH1coin = []
+    CH2coin = []
+    ii_start = 0
+    range_ps = 1e3 * range_ns
+    for jj in range(len(timestamps1)):
+        for ii in range(ii_start, len(timestamps2)):
+            dtt = timestamps2[ii] - timestamps1[jj] + peak0
+            if dtt < -range_ps / 2:
+                ii_start = ii
+            elif dtt > range_ps / 2:
+                break
+            else:
+                CH1coin.append(timestamps1[jj])
+                CH2coin.append(timestamps2[ii] + peak0)
+    dtime = np.array(CH1coin) - np.array(CH2coin)
+    histo_vals, bin_edges = np.histogram(dtime, bins=bins)
+    peak = bin_edges[np.argmax(histo_vals)]
+    return (histo_vals, bin_edges), peak
+
+def simulate_channels(tags, rate, pair_fraction, delay_ps, jitter_ps, seed=0):
+    """Two channels of Poisson timetags in ps, with a fraction of correlated pairs."""
+    rng = np.random.default_rng(seed)
+    duration_ps = tags / rate * 1e12
+    ch1 = rng.uniform(0, duration_ps, tags)
+    ch2 = rng.uniform(0, duration_ps, tags)
+    paired = int(tags * pair_fraction)
+    ch2[:paired] = ch1[:paired] + delay_ps + rng.normal(0, jitter_ps, paired)
+    return np.sort(np.round(ch1)), np.sort(np.round(ch2))
+
+def stream_matches(ch1, ch2, seconds, first_wrt=1488640.0, **options):
+    """
+    Whether CoincidenceAccumulator, fed the channels as `seconds` per WR second results with
+    timestamps relative to their second like the agents send them, counts what
+    calculate_coincidences counts on the whole channels, pairs across seconds included.
+    """
+    accumulator = CoincidenceAccumulator(1, 2, **options)
+    bounds = np.arange(seconds + 1) * PS_PER_SECOND
+    for second in range(seconds):
+        result = {}
+        for channel, timestamps in ((1, ch1), (2, ch2)):
+            chunk = timestamps[np.searchsorted(timestamps, bounds[second]):np.searchsorted(timestamps, bounds[second + 1])]
+            result[channel] = {first_wrt + second: chunk - bounds[second]}
+        accumulator.feed_result(result)
+    accumulator.flush()
+    (expected, _), _ = calculate_coincidences(ch1, ch2, fixed_range=True, **options)
+    return np.array_equal(accumulator.histogram()[0][0], expected)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tags", type=int, default=10_000_000, help="timestamps per channel")
+    parser.add_argument("--rate", type=float, default=3e6, help="tags per second per channel")
+    parser.add_argument("--reference-tags", type=int, default=20_000)
+    parser.add_argument("--peak0", type=float, default=2000)
+    parser.add_argument("--range-ns", type=float, default=5)
+    parser.add_argument("--bins", type=int, default=100)
+    parser.add_argument("--stream-seconds", type=int, default=3, help="WR seconds of the CoincidenceAccumulator check")
+    args = parser.parse_args()
+
+    ch1, ch2 = simulate_channels(args.tags, args.rate, pair_fraction=0.1, delay_ps=-args.peak0, jitter_ps=300)
+    options = dict(peak0=args.peak0, range_ns=args.range_ns, bins=args.bins)
+
+    # Same subset for both implementations: the first timestamps of each channel
+    n = args.reference_tags
+    start = time.perf_counter()
+    expected = notebook_calculate_coincidences(ch1[:n], ch2[:n], **options)
+    reference_per_tag = (time.perf_counter() - start) / n
+    got = calculate_coincidences(ch1[:n], ch2[:n], **options)
+    identical = (np.array_equal(expected[0][0], got[0][0]) and np.array_equal(expected[0][1], got[0][1])
+                 and expected[1] == got[1])
+
+    start = time.perf_counter()
+    (histo_vals, _), peak = calculate_coincidences(ch1, ch2, **options)
+    vectorized = time.perf_counter() - start
+    reference = reference_per_tag * args.tags
+
+    print(f"identical to notebook loop on {n} tags: {identical}")
+    # Integer ps over a few whole seconds, with the pairs made to straddle them too
+    stream1, stream2 = simulate_channels(int(args.rate * args.stream_seconds), args.rate, pair_fraction=0.1,
+                                         delay_ps=-args.peak0, jitter_ps=300, seed=1)
+    streamed = stream_matches(stream1.astype(np.int64), stream2.astype(np.int64), args.stream_seconds, **options)
+    print(f"accumulator identical across {args.stream_seconds} WR seconds: {streamed}")
+    print(f"notebook loop (extrapolated): {reference:10.2f} s for {args.tags} tags per channel")
+    print(f"vectorized:                   {vectorized:10.2f} s ({histo_vals.sum()} coincidences, peak {peak:.1f} ps)")
+    print(f"speedup:                      {reference / vectorized:10.1f}x")
+    print(f"{f'target of {TARGET_SPEEDUP}x:':30}{'met' if reference / vectorized >= TARGET_SPEEDUP else 'not met':>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Round trip, ratio and throughput of the framed timetag codecs against the pickle + blosc path.
+
+    python -m benchmarks.bench_data_compression --channels 2 --seconds 5 --rate 3e6
+"""
+import argparse
+import time
+import numpy as np
+from utils.data_compression import (CODEC_DELTA_BITSHUFFLE, compare_data_structures, compress_data_blosc,
+                                    decompress_data_blosc, pack_timetags, unpack_timetags)
+
+def simulate_data_store(channels, seconds, rate, seed=0):
+    """{channel: {wrt: sorted ps timetags}} with Poisson arrivals inside each WR second."""
+    rng = np.random.default_rng(seed)
+    data_store = {}
+    for channel in range(1, channels + 1):
+        data_store[channel] = {}
+        for second in range(seconds):
+            wrt = 1488640.0 + second
+            count = rng.poisson(rate)
+            data_store[channel][wrt] = np.sort(np.round(rng.uniform(0, 1e12, count)))
+    return data_store
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def report(name, data_store, encode, decode):
+    raw = sum(array.nbytes for chunks in data_store.values() for array in chunks.values())
+    encoded, encode_time = timed(encode, data_store)
+    decoded, decode_time = timed(decode, encoded)
+    print(f"{name:<22} ratio {raw / len(encoded):6.2f}  encode {raw / encode_time / 1e6:8.1f} MB/s  "
+          f"decode {raw / decode_time / 1e6:8.1f} MB/s  round trip equal: {compare_data_structures(data_store, decoded)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--seconds", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=3e6, help="tags per second per channel")
+    args = parser.parse_args()
+
+    data_store = simulate_data_store(args.channels, args.seconds, args.rate)
+    report("pickle + blosc (cl 9)", data_store, compress_data_blosc, decompress_data_blosc)
+    report("frames blosc", data_store, pack_timetags, unpack_timetags)
+    report("frames delta lz4", data_store, lambda data: pack_timetags(data, codec=CODEC_DELTA_BITSHUFFLE), unpack_timetags)
+    report("frames delta zstd", data_store, lambda data: pack_timetags(data, codec=CODEC_DELTA_BITSHUFFLE, cname="zstd"),
+           unpack_timetags)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+End-to-end latency, throughput and CPU of the client, its Broker relay and the AMQP broker.
+
+The AMQP broker (protocols.amqp.local_broker unless --broker is given) and a simulated timetagger
+agent run in their own processes, so that their CPU time can be told apart, and the
+MeasurementPlaneClient, with the utils.broker.Broker relay it embeds, runs in this one. The relay
+CPU is the thread CPU time spent in its callbacks. Reported, as JSON:
+    capabilities: get_capabilities round trip latency, relay CPU per request
+    specifications: specification to receipt round trip latency, relay CPU per specification
+    results: result throughput (msg/s, MB/s of message bodies), CPU per result message of the
+        client, the broker and the agent
+
+    python -m benchmarks.bench_end_to_end --results 5000 --tags 10000 --output e2e.json
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import numpy as np
+from MP_client import MeasurementPlaneClient
+from protocols.amqp.local_broker import LocalBroker, free_port
+from protocols.amqp.receive import Receiver, ReceiverHub
+from protocols.amqp.send import ConnectionPool, Sender
+from utils.message import Message
+from utils.result_sink import DiscardSink
+
+CAPABILITY = {
+    "capability": "measure-timetags",
+    "endpoint": "/bench/tt",
+    "capabilityName": "BenchTimetags",
+    "label": "bench",
+    "parameters_schema": {"type": "object", "properties": {
+        "results": {"type": "integer"}, "tags": {"type": "integer"}, "rate": {"type": "number"}}},
+    "resultSchema": {},
+}
+ANNOUNCE_INTERVAL = 1.0
+
+def result_payload(tags, seed=0):
+    """Body, content type and properties of a framed timetag result of two Poisson channels."""
+    rng = np.random.default_rng(seed)
+    data = {channel: {1488640.0: np.cumsum(rng.exponential(1e12 / max(tags, 1), tags)).round()} for channel in (1, 2)}
+    return Message.encode_timetags_result({"result": "ok", "resultValues": [data]})
+
+class BenchAgent:
+    """
+    Answers specifications of CAPABILITY with a receipt, then sends `results` framed timetag
+    messages of two channels holding `tags` Poisson timetags each, at `rate` messages per second
+    (0: as fast as the broker takes them), and an EOF_results message.
+    """
+    def __init__(self, broker_url):
+        self.broker_url = broker_url
+        self.sender = Sender()
+        self.running = True
+        self.receiver = Receiver(on_message_callback=self.on_specification)
+        self.receiver.start(broker_url, f"topic://{CAPABILITY['endpoint']}/specifications").wait_ready(timeout=10)
+        threading.Thread(target=self.announce, daemon=True).start()
+
+    def announce(self):
+        while self.running:
+            self.sender.send(self.broker_url, "topic:///capabilities", CAPABILITY)
+            time.sleep(ANNOUNCE_INTERVAL)
+
+    def on_specification(self, event):
+        specification = json.loads(event.message.body)
+        receipt = dict(specification)
+        receipt["receipt"] = specification.get("specification") or specification.get("interrupt")
+        self.sender.send(self.broker_url, event.message.reply_to, receipt)
+        if "interrupt" not in specification:
+            topic = f"topic://{Message.calculate_measurement_id(specification)}/results"
+            threading.Thread(target=self.stream, args=(topic, specification["parameters"]), daemon=True).start()
+
+    def stream(self, topic, parameters):
+        # One payload sent again and again, so that the agent measures the transport, not numpy
+        body, content_type, properties = result_payload(parameters.get("tags", 1000))
+        rate = parameters.get("rate", 0)
+        start = time.perf_counter()
+        futures = []
+        for index in range(parameters.get("results", 0)):
+            if rate:
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(self.sender.send(self.broker_url, topic, body, content_type=content_type, properties=properties))
+            if len(futures) >= 100:
+                # Keeps the sender queue bounded when the broker is the bottleneck
+                futures.pop(0).result(timeout=60)
+        for future in futures:
+            future.result(timeout=60)
+        self.sender.send(self.broker_url, topic, {"result": "ok", "resultValues": ["EOF_results"]})
+
+    def close(self):
+        self.running = False
+        self.receiver.stop()
+
+def serve(role, broker_url, connection):
+    """
+    Body of the child processes: start `role`, report ready, then answer "cpu" with the CPU
+    seconds used by the process so far, until "stop".
+    """
+    if role == "broker":
+        host, port = broker_url.split("//")[1].rstrip("/").split(":")
+        LocalBroker(host, int(port)).start()
+    elif role == "agent":
+        BenchAgent(broker_url)
+    connection.send("ready")
+    while True:
+        command = connection.recv()
+        if command == "stop":
+            return
+        connection.send(time.process_time())
+
+class Process:
+    def __init__(self, context, role, broker_url):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(role, broker_url, child), daemon=True)
+        self.process.start()
+        if not self.connection.poll(30):
+            raise RuntimeError(f"The {role} process did not start")
+        self.connection.recv()
+
+    def cpu(self):
+        self.connection.send("cpu")
+        return self.connection.recv()
+
+    def stop(self):
+        self.connection.send("stop")
+        self.process.join(5)
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1e3
+    return {"count": int(latencies.size), "mean_ms": float(latencies.mean()), "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)), "max_ms": float(latencies.max())}
+
+class CallbackTimer:
+    """Accumulates the thread CPU time of the callbacks of the receivers it wraps."""
+    def __init__(self, *receivers):
+        self.seconds = 0.0
+        for receiver in receivers:
+            receiver.on_message_callback = self.timed(receiver.on_message_callback)
+
+    def timed(self, callback):
+        def timed_callback(event):
+            start = time.thread_time()
+            try:
+                callback(event)
+            finally:
+                self.seconds += time.thread_time() - start
+        return timed_callback
+
+    def cpu(self):
+        return self.seconds
+
+def bench_capabilities(client, relay, requests):
+    latencies = []
+    cpu = relay.cpu()
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get_capabilities(refresh=True)
+        latencies.append(time.perf_counter() - start)
+    summary = latency_summary(latencies)
+    summary["relay_cpu_us_per_request"] = (relay.cpu() - cpu) / requests * 1e6
+    return summary
+
+def bench_specifications(client, capability, relay, specifications):
+    latencies = []
+    cpu = relay.cpu()
+    for index in range(specifications):
+        measurement = client.create_measurement(capability)
+        measurement.configure(schedule=f"now | bench {index}", parameters={"results": 0}, result_callback=lambda results: None)
+        start = time.perf_counter()
+        client.send_measurements([measurement], timeout=10)[0].result()
+        latencies.append(time.perf_counter() - start)
+        measurement.stop()
+    summary = latency_summary(latencies)
+    summary["relay_cpu_us_per_specification"] = (relay.cpu() - cpu) / specifications * 1e6
+    return summary
+
+def bench_results(client, capability, processes, results, tags, rate, window):
+    received = {"messages": 0, "first": None, "last": None}
+    done = threading.Event()
+
+    def on_results(values):
+        now = time.perf_counter()
+        if 'EOF_results' in values:
+            done.set()
+            return
+        received["messages"] += 1
+        received["first"] = received["first"] or now
+        received["last"] = now
+
+    measurement = client.create_measurement(capability)
+    measurement.configure(schedule="now | bench results", parameters={"results": results, "tags": tags, "rate": rate},
+                          result_callback=on_results, result_sink=DiscardSink(), result_window=window)
+    body_bytes = len(result_payload(tags)[0])
+    cpu = {role: process.cpu() for role, process in processes.items()}
+    client_cpu = time.process_time()
+    client.send_measurements([measurement], timeout=10)[0].result()
+    if not done.wait(timeout=max(60, results / 100)):
+        raise TimeoutError(f"Only {received['messages']} of {results} results arrived")
+    elapsed = received["last"] - received["first"] if received["messages"] > 1 else float("nan")
+    summary = {
+        "messages": received["messages"],
+        "message_bytes": body_bytes,
+        "seconds": elapsed,
+        "msgs_per_s": (received["messages"] - 1) / elapsed,
+        "MB_per_s": (received["messages"] - 1) * body_bytes / elapsed / 1e6,
+        "client_cpu_us_per_msg": (time.process_time() - client_cpu) / results * 1e6,
+    }
+    for role, process in processes.items():
+        summary[f"{role}_cpu_us_per_msg"] = (process.cpu() - cpu[role]) / results * 1e6
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", help="URL of a running broker, a local one is started otherwise")
+    parser.add_argument("--requests", type=int, default=50, help="get_capabilities requests timed")
+    parser.add_argument("--specifications", type=int, default=50, help="specification round trips timed")
+    parser.add_argument("--results", type=int, default=2000, help="result messages streamed")
+    parser.add_argument("--tags", type=int, default=1000, help="timetags per channel per result message")
+    parser.add_argument("--rate", type=float, default=0, help="result messages per second, 0 for as fast as possible")
+    parser.add_argument("--window", type=int, default=100, help="credit window of the results receiver")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    # Whatever the client prints goes to stderr, so that stdout holds the JSON report only
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+def run(args) -> dict:
+    # Spawn: the children must not inherit the reactor threads of this process
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    if args.broker:
+        broker_url = args.broker
+    else:
+        broker_url = f"amqp://localhost:{free_port()}/"
+        processes["broker"] = Process(context, "broker", broker_url)
+    processes["agent"] = Process(context, "agent", broker_url)
+
+    client = MeasurementPlaneClient(broker_url)
+    relay = CallbackTimer(client.broker.receiver_capabilities, client.broker.receiver_specifications,
+                          client.broker.receiver_get_capabilities)
+    deadline = time.time() + 30
+    capabilities = {}
+    while not capabilities and time.time() < deadline:
+        capabilities = client.get_capabilities(capability_types=[CAPABILITY["capability"]], refresh=True)
+    if not capabilities:
+        raise RuntimeError("The agent capability never reached the relay")
+    capability = capabilities[0]
+
+    report = {
+        "config": {**vars(args), "broker": broker_url, "local_broker": not args.broker},
+        "capabilities": bench_capabilities(client, relay, args.requests),
+        "specifications": bench_specifications(client, capability, relay, args.specifications),
+        "results": bench_results(client, capability, processes, args.results, args.tags, args.rate, args.window),
+    }
+    # Close this process' connections, then the agent, then the broker: a reactor thread still
+    # reconnecting to a broker that went away may crash the interpreter at exit
+    ReceiverHub.close_all(timeout=5)
+    ConnectionPool.default().close()
+    for process in reversed(list(processes.values())):
+        process.stop()
+    return report
+
+if __name__ == "__main__":
+    main()
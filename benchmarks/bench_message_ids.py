@@ -0,0 +1,80 @@
+"""
+Per-message cost of the capability, measurement and operation IDs of utils.message.Message.
+
+Compares the original implementation (kept here as the reference) with the cached legacy and
+canonical schemes, for messages seen before (capability announcements, receipts of the same
+measurements) and for messages that are all different.
+
+    python -m benchmarks.bench_message_ids --messages 20000
+"""
+import argparse
+import hashlib
+import time
+from utils.message import Message, ID_SCHEME_LEGACY, ID_SCHEME_CANONICAL, cached_capability_id, cached_measurement_id
+
+def original_combine_to_string(attributes):
+    combined_string = ""
+    for att in attributes:
+        att_str = str(att).replace(" ", "").replace("\n", "")
+        combined_string += att_str
+    return combined_string
+
+def original_capability_id(message):
+    return hashlib.sha256(original_combine_to_string([message["endpoint"], message["capabilityName"]]).encode()).hexdigest()
+
+def original_measurement_id(message):
+    capability_id = original_capability_id(message)
+    return hashlib.sha256(original_combine_to_string([capability_id, message["parameters"], message["schedule"]]).encode()).hexdigest()
+
+def original_operation_id(message):
+    measurement_id = original_measurement_id(message)
+    return hashlib.sha256(original_combine_to_string([measurement_id, message["nonce"], message["timestamp"]]).encode()).hexdigest()
+
+def make_message(index):
+    return {
+        "endpoint": f"/tt/timetagger{index}",
+        "capabilityName": "measure-coincidences",
+        "parameters": {"channels": [{"endpoint": f"/tt/timetagger{index}", "channel": 1},
+                                    {"endpoint": "/tt/timetagger0", "channel": 2}],
+                       "range_ns": 5, "bins": 100},
+        "schedule": "now | | stream",
+        "nonce": "1234567890abcdef",
+        "timestamp": "2024-06-13 12:34:56.00",
+    }
+
+def per_message(function, messages):
+    start = time.perf_counter()
+    for message in messages:
+        function(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--distinct", type=int, default=100, help="distinct messages of the repeated case")
+    args = parser.parse_args()
+
+    repeated = [make_message(index % args.distinct) for index in range(args.messages)]
+    distinct = [make_message(index) for index in range(args.messages)]
+    implementations = {
+        "original": (original_capability_id, original_measurement_id, original_operation_id),
+        ID_SCHEME_LEGACY: (Message.calculate_capability_id, Message.calculate_measurement_id, Message.calculate_operation_id),
+        ID_SCHEME_CANONICAL: (Message.calculate_capability_id, Message.calculate_measurement_id, Message.calculate_operation_id),
+    }
+
+    print(f"us per ID {'':<10}{'capability':>24}{'measurement':>24}{'operation':>24}")
+    print(f"{'':<20}" + f"{'repeated':>12}{'distinct':>12}" * 3)
+    for name, functions in implementations.items():
+        if name != "original":
+            Message.id_scheme = name
+        row = ""
+        for function in functions:
+            cached_capability_id.cache_clear()
+            cached_measurement_id.cache_clear()
+            row += f"{per_message(function, repeated):12.2f}{per_message(function, distinct):12.2f}"
+        print(f"{name:<20}{row}")
+    Message.id_scheme = ID_SCHEME_LEGACY
+    print(f"legacy IDs unchanged: {all(Message.calculate_operation_id(m) == original_operation_id(m) for m in distinct[:100])}")
+
+if __name__ == "__main__":
+    main()
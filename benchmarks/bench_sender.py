@@ -0,0 +1,46 @@
+"""
+Compare messages per second of the pooled Sender against the original per-call Container.
+
+Run from the repository root against a live broker:
+    python -m benchmarks.bench_sender --broker amqp://localhost:5672/ --count 2000
+"""
+import argparse
+import time
+from protocols.amqp.send import Sender, ConnectionPool
+
+def bench_per_call(broker_url, topic, count):
+    sender = Sender(pooled=False)
+    start = time.perf_counter()
+    for i in range(count):
+        sender.send(broker_url, topic, {"seq": i})
+    return count / (time.perf_counter() - start)
+
+def bench_pooled(broker_url, topic, count):
+    pool = ConnectionPool()
+    sender = Sender(pool=pool)
+    # Open the connection and the topic link before timing
+    sender.send(broker_url, topic, {"seq": -1}).result(timeout=10)
+    start = time.perf_counter()
+    futures = [sender.send(broker_url, topic, {"seq": i}) for i in range(count)]
+    for future in futures:
+        future.result(timeout=60)
+    rate = count / (time.perf_counter() - start)
+    pool.close()
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default="amqp://localhost:5672/")
+    parser.add_argument("--topic", default="topic:///bench_sender")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--per-call-count", type=int, default=100, help="per-call sends are slow, so fewer are timed")
+    args = parser.parse_args()
+
+    per_call = bench_per_call(args.broker, args.topic, args.per_call_count)
+    pooled = bench_pooled(args.broker, args.topic, args.count)
+    print(f"per-call Container: {per_call:10.1f} msg/s ({args.per_call_count} messages)")
+    print(f"pooled connection:  {pooled:10.1f} msg/s ({args.count} messages)")
+    print(f"speedup:            {pooled / per_call:10.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,45 @@
 import dash
-from dash import html, dcc, Input, Output, State, ALL, callback_context
+from dash import html, dcc, Input, Output, State, ALL, callback_context, Patch
 import plotly.graph_objs as go
 from measurement_plane.measurement_plane_client.MP_client import MeasurementPlaneClient
-import time, json
+import time, json, logging
+import threading
 import random  # Assuming random values for example purposes
+from utils.ring_buffer import RingBuffer, MinMaxDecimator
+from analysis.histogram import HistogramAccumulator
 
 class CountRatePlotter:
-    def __init__(self, channels):
+    def __init__(self, channels, window=300, history_decimation=None, history_capacity=1000):
+        """
+        Args:
+            channels (list): Channels to plot.
+            window (int): Number of latest points plotted, and kept, per channel.
+            history_decimation (int): If set, also keep a min/max envelope of blocks of that many
+                points, to plot a much longer history at constant memory.
+            history_capacity (int): Number of blocks kept in the history.
+        """
         self.channels = channels
-        self.channel_data = {channel: [] for channel in channels}
-        self.timestamps = []
+        self.window = window
+        self.history_decimation = history_decimation
+        self.history_capacity = history_capacity
+        self.timestamps = RingBuffer(window)
+        self.channel_data = {channel: RingBuffer(window) for channel in channels}
+        self.channel_history = {}
         self.start_time = None
+        self.lock = threading.RLock()
         self.reset()
 
     def reset(self):
         """Reset the internal data to start fresh and initialize the plot."""
-        self.channel_data = {channel: [] for channel in self.channels}
-        self.timestamps = []
-        self.start_time = None
+        with self.lock:
+            self.timestamps.clear()
+            for buffer in self.channel_data.values():
+                buffer.clear()
+            if self.history_decimation:
+                self.channel_history = {channel: MinMaxDecimator(self.history_decimation, self.history_capacity) for channel in self.channels}
+            self.start_time = None
+            self.figure_sent = False
+            self.unsent = 0  # points appended since the last update was sent to the browser
         return self.generate_empty_figure()
 
     def generate_empty_figure(self):
@@ -32,19 +54,61 @@ class CountRatePlotter:
         return figure
 
     def update_data(self, result):
-        if self.start_time is None:
-            self.start_time = time.time()
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
 
-        timestamp = time.time() - self.start_time
-        self.timestamps.append(timestamp)
+            timestamp = time.time() - self.start_time
+            self.timestamps.append(timestamp)
 
-        for channel in self.channels:
-            rate = result.get(channel, random.uniform(1, 10))
-            self.channel_data[channel].append(rate)
+            for channel in self.channels:
+                rate = result.get(channel, random.uniform(1, 10))
+                self.channel_data[channel].append(rate)
+                if channel in self.channel_history:
+                    self.channel_history[channel].append(timestamp, rate)
+            self.unsent += 1
+
+    def pending_update(self):
+        """
+        What the browser needs since the previous call, for the figure and extendData properties of
+        the graph: the whole figure the first time (or if more than a window was missed), then only
+        the new points of every trace, trimmed to the window on the browser side.
+
+        Returns:
+            tuple: figure or dash.no_update, extendData or dash.no_update.
+        """
+        with self.lock:
+            if not self.figure_sent or self.unsent > self.window:
+                return self.full_figure(), dash.no_update
+            if not self.unsent:
+                return dash.no_update, dash.no_update
+
+            timestamps = self.timestamps.last(self.unsent).tolist()
+            update = {
+                "x": [timestamps for _ in self.channel_data],
+                "y": [data.last(self.unsent).tolist() for data in self.channel_data.values()],
+            }
+            self.unsent = 0
+            return dash.no_update, (update, list(range(len(self.channel_data))), self.window)
+
+    def full_figure(self):
+        """The whole figure, counted as sent: the next pending_update only sends newer points."""
+        with self.lock:
+            self.figure_sent = True
+            self.unsent = 0
+            return self.generate_figure()
+
+    def generate_figure(self, history=False):
+        """
+        Figure of the latest `window` points of every channel, or of the decimated min/max history
+        if `history` is set and history_decimation was given. O(window) whatever the run length.
+        """
+        with self.lock:
+            return self._generate_figure(history)
+
+    def _generate_figure(self, history):
+        timestamps_to_plot = self.timestamps.last()
 
-    def generate_figure(self):
-        timestamps_to_plot = self.timestamps[-300:]
-        
         figure = go.Figure()
 
         # Define a color palette for the channels
@@ -55,7 +119,10 @@ class CountRatePlotter:
         
         # Loop through channels and assign colors based on index
         for idx, (channel, data) in enumerate(self.channel_data.items()):
-            data_to_plot = data[-300:]
+            if history and channel in self.channel_history:
+                timestamps_to_plot, data_to_plot = self.channel_history[channel].envelope()
+            else:
+                data_to_plot = data.last()
             color = colors[idx % len(colors)]  # Cycle through colors if more channels than colors
             figure.add_trace(go.Scatter(
                 x=timestamps_to_plot, 
@@ -76,13 +143,20 @@ class CountRatePlotter:
         return figure
 
 class CoincidencePlotter:
-    def __init__(self):
+    def __init__(self, decay=None, window=None):
+        """
+        Args:
+            decay (float): If set, older histograms fade by this factor per update.
+            window (int): If set, only the latest `window` histograms are summed.
+        """
+        self.accumulator = HistogramAccumulator(decay=decay, window=window)
         self.reset()
 
     def reset(self):
         """Reset the internal data to start fresh and initialize the plot."""
-        self.accumulated_histogram = []  # Empty histogram data
-        self.bin_edges = []  # Empty bin edges
+        self.accumulator.reset()
+        self.figure_sent = False
+        self.changed = False  # histograms added since the last update was sent to the browser
         self.empty_figure = self.generate_empty_figure()  # Generate and store a blank figure
 
     def generate_empty_figure(self):
@@ -97,24 +171,41 @@ class CoincidencePlotter:
         return figure
 
     def update_data(self, result):
-        # Extract histogram data from result
-        histo_vals = result["histo_vals"]
-        bin_edges = result["bin_edges"]
-
-        # Initialize bin edges and histogram if not set
-        if not self.accumulated_histogram:
-            self.accumulated_histogram = histo_vals
-            self.bin_edges = bin_edges
-        else:
-            # Accumulate histogram values
-            self.accumulated_histogram = [
-                x + y for x, y in zip(self.accumulated_histogram, histo_vals)
-            ]
+        # Results with other bin edges than the first one are rebinned onto its edges
+        self.accumulator.add(result["histo_vals"], result["bin_edges"])
+        self.changed = True
+
+    def pending_update(self):
+        """
+        What the browser needs since the previous call: the whole figure the first time, then a
+        Patch of the bar heights only, the bin edges being fixed by the first histogram.
+
+        Returns:
+            tuple: figure, Patch or dash.no_update, and dash.no_update for extendData.
+        """
+        if not self.changed:
+            return dash.no_update, dash.no_update
+        if not self.figure_sent:
+            return self.full_figure(), dash.no_update
+        # Cleared before reading, a histogram added meanwhile is sent on the next call
+        self.changed = False
+        accumulated_histogram, _ = self.accumulator.histogram()
+        patch = Patch()
+        patch["data"][0]["y"] = accumulated_histogram.tolist()
+        return patch, dash.no_update
+
+    def full_figure(self):
+        """The whole figure, counted as sent once it has the histogram trace the patches update."""
+        self.changed = False
+        figure = self.generate_figure()
+        self.figure_sent = bool(figure.data)
+        return figure
 
     def generate_figure(self):
         """Generate a figure based on accumulated data."""
+        accumulated_histogram, bin_edges = self.accumulator.histogram()
         # Check if accumulated data is empty
-        if not self.accumulated_histogram or not self.bin_edges:
+        if accumulated_histogram is None:
             return self.empty_figure
 
         # Create a histogram plot
@@ -122,8 +213,8 @@ class CoincidencePlotter:
 
         # Plot the accumulated histogram
         figure.add_trace(go.Bar(
-            x=self.bin_edges[:-1],  # Use the left edges of the bins
-            y=self.accumulated_histogram,
+            x=bin_edges[:-1],  # Use the left edges of the bins
+            y=accumulated_histogram,
             name="Coincidences",
             marker=dict(color="#1f77b4")
         ))
@@ -138,6 +229,16 @@ class CoincidencePlotter:
 
         return figure
 
+class RunningMeasurement:
+    """One measurement of the GUI, with the plotter of its own figure panel."""
+    def __init__(self, key, measurement, measurement_type, label, plotter):
+        self.key = key
+        self.measurement = measurement
+        self.measurement_type = measurement_type
+        self.label = label
+        self.plotter = plotter
+        self.running = True
+
 class MeasurementPlaneApp:
     def __init__(self, broker_url):
         self.app = dash.Dash(__name__)
@@ -145,12 +246,13 @@ class MeasurementPlaneApp:
         
 
         self.capabilities = {}
-        self.current_measurement = None
-        self.current_measurement_type = None
+        # Measurements shown, by key, in start order. Their results all arrive through the shared
+        # receiver connection of the client, each subscription calling back into its own plotter
+        self.measurements = {}
+        self.measurements_lock = threading.Lock()
+        self.measurement_counter = 0
         
         self.supported_capabilities = ["measure-count-rate", "measure-coincidences"]
-        self.plotter = None
-        self.latest_figure_data = None  # Store the latest figure data here
 
         self.setup_layout()
         self.setup_callbacks()
@@ -265,13 +367,14 @@ class MeasurementPlaneApp:
                     html.Div([
                         html.H2("Measurement Controll", style={"textAlign": "center", "marginBottom": "20px"}),
                         html.Button("Start Measurement", id="start-measurement-btn", n_clicks=0, style={"marginRight": "10px"}),
-                        html.Button("Stop Measurement", id="stop-measurement-btn", n_clicks=0),
+                        html.Button("Stop All Measurements", id="stop-measurement-btn", n_clicks=0),
                     ], style={"marginBottom": "20px", "textAlign": "center"}),
                     html.Hr(),
                     # Results Graph
                     html.H2("Measurement Results", style={"textAlign": "center", "marginBottom": "20px"}),
                     
-                    dcc.Graph(id="measurement-plot"),
+                    # One panel per measurement, see render_measurement_panels
+                    html.Div(id="measurement-plots", children=[]),
 
                     # Status
                     html.Div(id="status", children="Status: Waiting for action", 
@@ -465,9 +568,6 @@ class MeasurementPlaneApp:
             prevent_initial_call=True
         )
         def update_parameters_inputs(selected_capability_id):
-            if self.plotter:
-                self.plotter.generate_empty_figure()
-
             if selected_capability_id is None or selected_capability_id not in self.capabilities:
                 return []
 
@@ -492,8 +592,10 @@ class MeasurementPlaneApp:
         
         @self.app.callback(
             Output("status", "children"),
+            Output("measurement-plots", "children"),
             Input("start-measurement-btn", "n_clicks"),
             Input("stop-measurement-btn", "n_clicks"),
+            Input({"type": "measurement-panel-btn", "index": ALL}, "n_clicks"),
             State("capability-dropdown", "value"),
             State({"type": "param-input", "index": ALL}, "value"),
             State({"type": "param-input", "index": ALL}, "id"),
@@ -510,18 +612,15 @@ class MeasurementPlaneApp:
             prevent_initial_call=True
         )
         def handle_measurement_actions(
-                start_n_clicks, stop_n_clicks, capability_id, param_values, param_ids,
+                start_n_clicks, stop_n_clicks, panel_n_clicks, capability_id, param_values, param_ids,
                 start_option, custom_start_date, start_hours, start_minutes, start_seconds,
                 end_date, end_hours, end_minutes, end_seconds, schedule_options
             ):
-            triggered_id = callback_context.triggered[0]["prop_id"].split(".")[0]
+            triggered_id = callback_context.triggered_id
 
             if triggered_id == "start-measurement-btn":
-                if self.current_measurement is not None:
-                    return "A measurement is already active. Please stop it before starting a new one."
-
                 if capability_id is None or capability_id not in self.capabilities:
-                    return "Please select a valid capability."
+                    return "Please select a valid capability.", dash.no_update
                 
                 # Generate the schedule string using the helper function
                 try:
@@ -530,66 +629,131 @@ class MeasurementPlaneApp:
                         end_date, end_hours, end_minutes, end_seconds, schedule_options
                     )
                 except ValueError as e:
-                    return str(e)
+                    return str(e), dash.no_update
                 
                 # Reconstruct parameters dynamically
                 parameters = self.reconstruct_parameters(param_ids, param_values)
                 print("Reconstructed Parameters:", parameters)
         
-                if self.plotter:
-                    figure = self.plotter.generate_empty_figure()
-                    self.latest_figure_data = {'figure': figure} 
-
                 selected_capability = self.capabilities[capability_id]
-                parameters_schema = selected_capability.get("parameters_schema", {})
-                
-
-                self.current_measurement = self.mpClient.create_measurement(selected_capability)
-                self.current_measurement.configure(
-                    schedule=schedule,
-                    parameters=parameters,
-                    result_callback=self.on_result_callback,
-                )
-                self.mpClient.send_measurement(self.current_measurement)
-                self.current_measurement_type = selected_capability.get("capability") if selected_capability else None
-                if self.current_measurement_type == "measure-count-rate":
-                    self.plotter = CountRatePlotter(parameters["channels"])
-                elif self.current_measurement_type == "measure-coincidences":  
-                    self.plotter = CoincidencePlotter()
-                else:
-                    self.plotter = None
-
-                return "Measurement started. Awaiting results..."
+                running = self.start_measurement(selected_capability, schedule, parameters)
+                return f"Measurement {running.key} started. Awaiting results...", self.render_measurement_panels()
 
             elif triggered_id == "stop-measurement-btn":
-                if self.current_measurement:
-                    self.mpClient.interrupt_measurement(self.current_measurement)
-                    self.current_measurement = None
-                    return "Measurement stopped."
-
-                return "No active measurement to stop."
+                with self.measurements_lock:
+                    to_stop = [running for running in self.measurements.values() if running.running]
+                if not to_stop:
+                    return "No active measurement to stop.", dash.no_update
+                self.stop_measurements(to_stop)
+                return f"{len(to_stop)} measurement(s) stopped.", self.render_measurement_panels()
+
+            elif isinstance(triggered_id, dict) and triggered_id.get("type") == "measurement-panel-btn":
+                # Panels are rendered with n_clicks=0, only a real click stops or closes one
+                if not callback_context.triggered[0]["value"]:
+                    return dash.no_update, dash.no_update
+                with self.measurements_lock:
+                    running = self.measurements.get(triggered_id["index"])
+                if running is None:
+                    return dash.no_update, dash.no_update
+                if running.running:
+                    self.stop_measurements([running])
+                    status = f"Measurement {running.key} stopped."
+                else:
+                    with self.measurements_lock:
+                        del self.measurements[running.key]
+                    status = f"Measurement {running.key} closed."
+                return status, self.render_measurement_panels()
 
-            return dash.no_update
+            return dash.no_update, dash.no_update
 
         @self.app.callback(
-            Output("measurement-plot", "figure"),
+            Output({"type": "measurement-plot", "index": ALL}, "figure"),
+            Output({"type": "measurement-plot", "index": ALL}, "extendData"),
             Input("interval-component", "n_intervals"),
+            State({"type": "measurement-plot", "index": ALL}, "id"),
             prevent_initial_call=True
         )
-        def update_measurement_plot(n_intervals):
-            # Check if there is new data to push
-            if self.latest_figure_data:
-                figure = self.latest_figure_data["figure"]
-                self.latest_figure_data = None  # Clear the stored data after pushing
-                return figure
-            return dash.no_update
-
-    def on_result_callback(self, result):
-        if self.plotter:
-            self.plotter.update_data(result[0])
-            figure = self.plotter.generate_figure()
-            # Update the latest figure data
-            self.latest_figure_data = {'figure': figure} 
+        def update_measurement_plot(n_intervals, plot_ids):
+            # Figures are only built here, when the browser asks, and only what changed is sent
+            figures, extensions = [], []
+            with self.measurements_lock:
+                measurements = dict(self.measurements)
+            for plot_id in plot_ids:
+                running = measurements.get(plot_id["index"])
+                if running is not None and running.plotter:
+                    figure, extension = running.plotter.pending_update()
+                else:
+                    figure, extension = dash.no_update, dash.no_update
+                figures.append(figure)
+                extensions.append(extension)
+            return figures, extensions
+
+    def start_measurement(self, capability, schedule, parameters) -> RunningMeasurement:
+        measurement_type = capability.get("capability")
+        if measurement_type == "measure-count-rate":
+            plotter = CountRatePlotter(parameters["channels"])
+        elif measurement_type == "measure-coincidences":  
+            plotter = CoincidencePlotter()
+        else:
+            plotter = None
+
+        with self.measurements_lock:
+            self.measurement_counter += 1
+            key = str(self.measurement_counter)
+        label = f"#{key} {capability.get('label', measurement_type)} ({capability.get('endpoint', '')})"
+
+        # Registered with its plotter before it is sent, so that no early result is lost
+        measurement = self.mpClient.create_measurement(capability)
+        running = RunningMeasurement(key, measurement, measurement_type, label, plotter)
+        measurement.configure(
+            schedule=schedule,
+            parameters=parameters,
+            result_callback=lambda result: self.on_result_callback(running, result),
+        )
+        with self.measurements_lock:
+            self.measurements[key] = running
+        self.mpClient.send_measurement(measurement)
+        return running
+
+    def stop_measurements(self, to_stop: list):
+        """
+        Interrupt the measurements with one send_measurements call, without waiting for the
+        receipts: the Dash callback returns at once however many measurements are stopped.
+        """
+        interruptions = []
+        for running in to_stop:
+            running.running = False
+            interruptions.append(running.measurement.create_interruption())
+        futures = self.mpClient.send_measurements(interruptions, timeout=2)
+        for running, future in zip(to_stop, futures):
+            future.add_done_callback(lambda future, key=running.key: future.exception() and logging.error(
+                f"Interruption of measurement {key} failed: {future.exception()}"))
+            running.measurement.stop()
+
+    def render_measurement_panels(self) -> list:
+        """
+        A title, a stop (or close) button and a graph per measurement. The graphs are created with
+        their current figure, so that the interval tick then only sends what changes.
+        """
+        with self.measurements_lock:
+            measurements = list(self.measurements.values())
+        panels = []
+        for running in measurements:
+            figure = running.plotter.full_figure() if running.plotter else go.Figure()
+            panels.append(html.Div([
+                html.Div([
+                    html.H3(running.label, style={"display": "inline-block", "marginRight": "20px"}),
+                    html.Button("Stop" if running.running else "Close",
+                                id={"type": "measurement-panel-btn", "index": running.key}, n_clicks=0),
+                ]),
+                dcc.Graph(id={"type": "measurement-plot", "index": running.key}, figure=figure),
+            ], style={"marginBottom": "20px"}))
+        return panels
+
+    def on_result_callback(self, running: RunningMeasurement, result):
+        # Runs on the AMQP receive thread: only record the data, the interval tick builds the update
+        if running.plotter:
+            running.plotter.update_data(result[0])
     
     def run(self):
         self.app.run_server(debug=True, use_reloader=False)
@@ -0,0 +1,156 @@
+#standards imports
+import sys, socket, logging, threading, collections
+
+#imports to use AMQP 1.0 communication protocol
+from proton import Condition, Link
+from protocols.amqp.reactor import ReactorThread
+
+# Seconds the clients get to answer the close of their connections before the reactor stops anyway
+CLOSE_TIMEOUT = 1.0
+
+def free_port(host="localhost") -> int:
+    """A TCP port that was free a moment ago, for a LocalBroker that nothing else should share."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+class LocalBroker(ReactorThread):
+    """
+    Minimal AMQP 1.0 broker on its own reactor thread, a stand-in for the real broker when
+    benchmarking or trying the client offline:
+
+        broker = LocalBroker().start()
+        client = MeasurementPlaneClient(broker.url)
+        ...
+        broker.close()
+
+    Every message sent to an address is copied to each receiver link attached to that address at
+    the time (topic semantics, nothing is kept for later subscribers). Messages wait in a queue
+    per receiver link until it grants credit, and links asking for pre-settled deliveries get them.
+    """
+    def __init__(self, host="localhost", port=None):
+        self.port = port if port is not None else free_port(host)
+        super(LocalBroker, self).__init__(f"{host}:{self.port}")
+        self.url = f"amqp://{host}:{self.port}/"
+        self.acceptor = None
+        self.listening = threading.Event()
+        self.subscribers = collections.defaultdict(set)  # address -> sender links
+        self.queues = {}  # sender link -> messages waiting for credit
+        self.connections = set()  # accepted connections
+
+    def start(self, timeout=10):
+        super(LocalBroker, self).start()
+        if not self.listening.wait(timeout):
+            raise TimeoutError(f"Local broker did not start listening on {self.server}")
+        return self
+
+    def on_start(self, event):
+        # Listen instead of connecting
+        self.acceptor = event.container.listen(self.server)
+        logging.info(f"Local broker listening on {self.url}")
+        self.listening.set()
+
+    def _close(self):
+        self.closed = True
+        if self.acceptor:
+            self.acceptor.close()
+        # Closed as "forced", clients take it as the broker going away (on_disconnected, then
+        # reconnection) rather than waiting on a silent socket. container.stop() would drop the
+        # close frames, so the reactor only stops once the connections are closed, or after
+        # CLOSE_TIMEOUT for clients that never answer.
+        for connection in list(self.connections):
+            connection.condition = Condition("amqp:connection:forced", "Local broker closed")
+            connection.close()
+        self.injector.close()
+        if self.connections:
+            self.container.schedule(CLOSE_TIMEOUT, StopTimer(self.container))
+        else:
+            self.container.stop()
+
+    def on_connection_opening(self, event):
+        self.connections.add(event.connection)
+
+    def on_link_opening(self, event):
+        link = event.link
+        if link.is_sender:
+            address = link.remote_source.address
+            link.source.address = address
+            link.snd_settle_mode = link.remote_snd_settle_mode
+            self.subscribers[address].add(link)
+            self.queues[link] = collections.deque()
+        else:
+            link.target.address = link.remote_target.address
+
+    def on_link_closing(self, event):
+        self._remove(event.link)
+
+    def on_connection_closing(self, event):
+        self._remove_links(event.connection)
+        self._forget(event.connection)
+
+    def on_connection_closed(self, event):
+        self._forget(event.connection)
+
+    def on_disconnected(self, event):
+        self._remove_links(event.connection)
+        self._forget(event.connection)
+
+    def on_transport_closed(self, event):
+        if event.connection:
+            self._forget(event.connection)
+
+    def on_transport(self, event):
+        transport = event.transport
+        if self.closed and transport is not None and transport.pending() < 0:
+            # The close frame is written, and clients drop a forced connection without answering
+            transport.close_tail()
+
+    def on_transport_error(self, event):
+        # Closing the tail of the transports reports them aborted, which is expected here
+        if not self.closed:
+            super(LocalBroker, self).on_transport_error(event)
+
+    def _forget(self, connection):
+        self.connections.discard(connection)
+        if self.closed and not self.connections:
+            self.container.stop()
+
+    def _remove(self, link):
+        if link.is_sender and link in self.queues:
+            self.subscribers[link.source.address].discard(link)
+            del self.queues[link]
+
+    def _remove_links(self, connection):
+        link = connection.link_head(0)
+        while link:
+            self._remove(link)
+            link = link.next(0)
+
+    def on_sendable(self, event):
+        self._flush(event.link)
+
+    def _flush(self, link):
+        messages = self.queues.get(link)
+        while messages and link.credit:
+            delivery = link.send(messages.popleft())
+            if link.snd_settle_mode == Link.SND_SETTLED:
+                delivery.settle()
+
+    def on_message(self, event):
+        address = event.link.target.address or event.message.address
+        for link in list(self.subscribers.get(address, ())):
+            self.queues[link].append(event.message)
+            self._flush(link)
+
+class StopTimer:
+    def __init__(self, container):
+        self.container = container
+
+    def on_timer_task(self, event):
+        self.container.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else "localhost:5672").partition(":")
+    broker = LocalBroker(host, int(port or 5672)).start()
+    broker.thread.join()
@@ -0,0 +1,101 @@
+#standards imports
+import queue, threading, logging, traceback, time
+
+#imports to use AMQP 1.0 communication protocol
+from proton.handlers import MessagingHandler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+from utils import metrics
+
+class ReactorThread(MessagingHandler):
+    """
+    A proton Container running on its own daemon thread with a single connection to `server`.
+
+    Proton objects may only be touched from the reactor thread, so other threads hand work
+    over with `call()`, which queues a function and wakes the reactor through an EventInjector.
+    """
+    def __init__(self, server, **handler_options):
+        super(ReactorThread, self).__init__(**handler_options)
+        self.server = server
+        self.conn = None
+        self.connecting_since = None
+        self.closed = False
+        self.commands = queue.SimpleQueue()
+        self.injector = EventInjector()
+        self.container = Container(self)
+        self.container.selectable(self.injector)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.container.run()
+        except Exception:
+            traceback.print_exc()
+
+    def on_start(self, event):
+        self.connecting_since = time.perf_counter()
+        self.conn = event.container.connect(self.server)
+
+    def on_connection_opened(self, event):
+        if metrics.enabled and self.connecting_since is not None:
+            metrics.histogram("amqp_connection_setup_seconds", "Connect to connection opened by the broker",
+                              server=self.server, role=type(self).__name__).observe(time.perf_counter() - self.connecting_since)
+        self.connecting_since = None
+
+    def call(self, function, *args):
+        """Run function(*args) on the reactor thread. Safe to call from any thread."""
+        self.commands.put((function, args))
+        self.injector.trigger(ApplicationEvent("reactor_command"))
+
+    def call_later(self, delay, function, *args):
+        """Run function(*args) on the reactor thread after `delay` seconds. Safe to call from any thread."""
+        self.call(lambda: self.container.schedule(delay, DelayedCall(function, args)))
+
+    def on_reactor_command(self, event):
+        while True:
+            try:
+                function, args = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def close(self, timeout=None):
+        """Close the connection, stop the reactor and wait for its thread to exit."""
+        if self.closed:
+            return
+        self.call(self._close)
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def _close(self):
+        self.closed = True
+        if self.conn:
+            self.conn.close()
+        self.injector.close()
+        self.container.stop()
+
+    def on_connection_error(self, event):
+        logging.error(f"Connection error on server: {self.server}")
+        super(ReactorThread, self).on_connection_error(event)
+
+    def on_transport_error(self, event):
+        logging.error(f"Transport error on server: {self.server}")
+        super(ReactorThread, self).on_transport_error(event)
+
+class DelayedCall:
+    """Timer task of ReactorThread.call_later."""
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def on_timer_task(self, event):
+        try:
+            self.function(*self.args)
+        except Exception:
+            traceback.print_exc()
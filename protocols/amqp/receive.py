@@ -1,37 +1,269 @@
 #standards imports
-import traceback, logging
+import traceback, logging, threading, uuid, time
+from collections import deque
 
 #imports to use AMQP 1.0 communication protocol
-from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import AtLeastOnce, AtMostOnce
+from protocols.amqp.reactor import ReactorThread
+from utils import metrics
+
+# Messages a subscription may have in flight (granted credit plus unreleased), proton's default prefetch
+DEFAULT_WINDOW = 10
+# Delivery modes: settled on arrival (a message may be lost, never redelivered) or accepted once processed
+AT_MOST_ONCE = "at-most-once"
+AT_LEAST_ONCE = "at-least-once"
+# Longest wait of a batched acknowledgement when no ack_interval is given
+DEFAULT_ACK_INTERVAL = 0.1
 
 class Receiver():
+    """
+    Listens on one topic. Thin wrapper over the shared ReceiverHub of the server.
+    """
     def __init__(self, on_message_callback=None):
         super(Receiver, self).__init__()
         self.on_message_callback = on_message_callback
+        self.subscription = None
+        self.stopped = threading.Event()
+
+    def start(self, server, topic, **subscription_options) -> 'Subscription':
+        """Subscribe to the topic without blocking the calling thread. See Subscription for the options."""
+        self.stopped.clear()
+        self.subscription = ReceiverHub.for_server(server).subscribe(topic, self.on_message, **subscription_options)
+        return self.subscription
 
     def receive_event(self, server, topic):
-        self.handler = self.event_Receiver_handller(server, topic, self.on_message_callback)
-        self.container = Container(self.handler)
-        self.container.run()
-
-    class event_Receiver_handller(MessagingHandler):
-        def __init__(self, server, topic, on_message_callback=None):
-            super(Receiver.event_Receiver_handller, self).__init__()
-            self.server = server
-            self.topic = topic
-            self.on_message_callback = on_message_callback
-            logging.info("Agent will start listening for events in the topic: {}".format(self.topic))
-
-        def on_start(self, event):
-            self.conn = event.container.connect(self.server)
-            event.container.create_receiver(self.conn, self.topic)
-
-        def on_message(self, event):
-            try:
-                # Call the custom on_message callback if provided
-                if self.on_message_callback:
-                    self.on_message_callback(event)
-
-            except Exception:
-                traceback.print_exc()
+        """Subscribe to the topic and block until stop() is called."""
+        self.start(server, topic)
+        self.stopped.wait()
+
+    def stop(self):
+        if self.subscription:
+            self.subscription.close()
+        self.stopped.set()
+
+    def on_message(self, event):
+        try:
+            # Call the custom on_message callback if provided
+            if self.on_message_callback:
+                self.on_message_callback(event)
+
+        except Exception:
+            traceback.print_exc()
+
+class Subscription():
+    """
+    One receiver link of a ReceiverHub, delivering the messages of `topic` to its callback.
+
+    Flow control is credit based: the broker sends at most `window` messages that were not
+    released yet. A message is released when the callback returns, or, with `manual_release`,
+    when the consumer calls release(): a consumer that falls behind stops granting credit and
+    the messages wait at the broker instead of piling up in memory here. A large window suits
+    high-rate result streams, a small one keeps control topics fair.
+
+    With AT_LEAST_ONCE delivery (the default) a message is accepted once released, so the broker
+    may redeliver what was not processed; acknowledgements are batched every `ack_batch`
+    messages, or after `ack_interval` seconds for an incomplete batch. With AT_MOST_ONCE the
+    broker sends messages settled and nothing is acknowledged.
+    """
+    def __init__(self, hub, topic, on_message_callback, window=DEFAULT_WINDOW, manual_release=False,
+                 delivery_mode=AT_LEAST_ONCE, ack_batch=1, ack_interval=None):
+        if window < 1:
+            raise ValueError(f"Window must be at least 1, got {window}")
+        if delivery_mode not in (AT_MOST_ONCE, AT_LEAST_ONCE):
+            raise ValueError(f"Unknown delivery mode {delivery_mode}")
+        if ack_batch < 1:
+            raise ValueError(f"ack_batch must be at least 1, got {ack_batch}")
+        self.hub = hub
+        self.topic = topic
+        self.on_message_callback = on_message_callback
+        self.window = window
+        self.manual_release = manual_release
+        self.delivery_mode = delivery_mode
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval if ack_interval is not None or ack_batch == 1 else DEFAULT_ACK_INTERVAL
+        # Reactor thread only: deliveries handed to the callback and not released (None once
+        # nothing is left to acknowledge), released deliveries waiting for their batch, its timer
+        self.unreleased = deque()
+        self.unacknowledged = []
+        self.ack_timer = None
+        self.link = None
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.ready_callbacks = []
+        self.lock = threading.Lock()
+
+    def wait_ready(self, timeout=None) -> bool:
+        """Wait until the broker has attached the link, so that no message sent afterwards is missed."""
+        return self.ready.wait(timeout)
+
+    def add_ready_callback(self, callback):
+        """Call `callback()` once the link is attached, right away if it already is."""
+        with self.lock:
+            if not self.ready.is_set():
+                self.ready_callbacks.append(callback)
+                return
+        callback()
+
+    def set_ready(self):
+        with self.lock:
+            self.ready.set()
+            callbacks, self.ready_callbacks = self.ready_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def release(self, count=1):
+        """Mark `count` messages as processed, granting as much credit back. Safe from any thread."""
+        self.hub.call(self.hub._release, self, count)
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+class ReceiverHub(ReactorThread):
+    """
+    One reactor thread and one connection per broker, multiplexing any number of topic
+    subscriptions that can be added and removed at runtime.
+
+    Callbacks run on the reactor thread and should return quickly: a slow callback delays
+    every other subscription of the hub.
+    """
+    _hubs = {}
+    _hubs_lock = threading.Lock()
+
+    def __init__(self, server):
+        # No automatic prefetch or acknowledgement: every subscription manages both for its link
+        super(ReceiverHub, self).__init__(server, prefetch=0, auto_accept=False)
+        self.subscriptions = {}
+
+    @classmethod
+    def for_server(cls, server) -> 'ReceiverHub':
+        """Return the shared hub of `server`, starting it on first use."""
+        with cls._hubs_lock:
+            hub = cls._hubs.get(server)
+            if hub is None or hub.closed:
+                hub = cls(server).start()
+                cls._hubs[server] = hub
+            return hub
+
+    @classmethod
+    def close_all(cls, timeout=None):
+        """Close the hubs of every server, e.g. before the broker goes away at the end of a run."""
+        with cls._hubs_lock:
+            hubs, cls._hubs = list(cls._hubs.values()), {}
+        for hub in hubs:
+            hub.close(timeout)
+
+    def subscribe(self, topic, on_message_callback, **subscription_options) -> Subscription:
+        logging.info("Agent will start listening for events in the topic: {}".format(topic))
+        subscription = Subscription(self, topic, on_message_callback, **subscription_options)
+        self.call(self._attach, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.closed.set()
+        self.call(self._detach, subscription)
+
+    def _attach(self, subscription):
+        if subscription.closed.is_set():
+            return
+        # Proton names links after the container and the topic, two subscriptions to one topic would clash
+        delivery_option = AtMostOnce() if subscription.delivery_mode == AT_MOST_ONCE else AtLeastOnce()
+        subscription.link = self.container.create_receiver(self.conn, subscription.topic, name=f"{subscription.topic}-{uuid.uuid4()}",
+                                                           options=delivery_option)
+        self.subscriptions[subscription.link] = subscription
+        self._grant_credit(subscription)
+
+    def _grant_credit(self, subscription):
+        credit = subscription.window - len(subscription.unreleased) - subscription.link.credit
+        if credit > 0:
+            subscription.link.flow(credit)
+
+    def _release(self, subscription, count):
+        for _ in range(min(count, len(subscription.unreleased))):
+            delivery = subscription.unreleased.popleft()
+            if delivery is not None:
+                subscription.unacknowledged.append(delivery)
+        if subscription.link is None or subscription.closed.is_set():
+            return
+        if len(subscription.unacknowledged) >= subscription.ack_batch:
+            self._acknowledge(subscription)
+        elif subscription.unacknowledged and subscription.ack_timer is None:
+            subscription.ack_timer = self.container.schedule(subscription.ack_interval, AcknowledgementTimer(self, subscription))
+        self._grant_credit(subscription)
+
+    def _acknowledge(self, subscription):
+        if subscription.ack_timer is not None:
+            subscription.ack_timer.cancel()
+            subscription.ack_timer = None
+        for delivery in subscription.unacknowledged:
+            if not delivery.settled:
+                self.accept(delivery)
+        subscription.unacknowledged.clear()
+
+    def _detach(self, subscription):
+        if subscription.link is not None and self.subscriptions.pop(subscription.link, None):
+            self._acknowledge(subscription)
+            subscription.link.close()
+
+    def on_link_opened(self, event):
+        subscription = self.subscriptions.get(event.link)
+        if subscription:
+            subscription.set_ready()
+
+    def on_message(self, event):
+        subscription = self.subscriptions.get(event.link)
+        if subscription is None or subscription.closed.is_set():
+            return
+        if subscription.delivery_mode == AT_MOST_ONCE or event.delivery.settled:
+            # Pre-settled, or settled here if the broker ignored the requested mode
+            if not event.delivery.settled:
+                self.accept(event.delivery)
+            subscription.unreleased.append(None)
+        else:
+            subscription.unreleased.append(event.delivery)
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            subscription.on_message_callback(event)
+        except Exception:
+            traceback.print_exc()
+        if not subscription.manual_release:
+            self._release(subscription, 1)
+        if start is not None:
+            self._observe(subscription, event, start)
+
+    def _observe(self, subscription, event, start):
+        topic = metrics.topic_label(subscription.topic)
+        metrics.histogram("amqp_receive_callback_seconds", "Message callback of a subscription", topic=topic).observe(
+            time.perf_counter() - start)
+        metrics.counter("amqp_messages_received_total", "Messages received", topic=topic).inc()
+        metrics.counter("amqp_bytes_received_total", "Bytes of the message bodies received", topic=topic).inc(
+            metrics.body_size(event.message.body))
+        metrics.gauge("amqp_receive_unreleased", "Messages received and not released by the consumer yet", topic=topic).set(
+            len(subscription.unreleased))
+
+    def on_disconnected(self, event):
+        logging.error(f"disconnected from server: {self.server}, re-attaching {len(self.subscriptions)} subscriptions")
+        # Proton reconnects the connection; give every live subscription a fresh link on it
+        subscriptions = list(self.subscriptions.values())
+        for link in self.subscriptions:
+            link.close()
+        self.subscriptions.clear()
+        for subscription in subscriptions:
+            # Deliveries of the old link can no longer be acknowledged, the broker redelivers them
+            subscription.unreleased = deque([None] * len(subscription.unreleased))
+            subscription.unacknowledged.clear()
+            if subscription.ack_timer is not None:
+                subscription.ack_timer.cancel()
+                subscription.ack_timer = None
+            subscription.ready.clear()
+            self._attach(subscription)
+
+class AcknowledgementTimer:
+    """Acknowledges the incomplete batch of a subscription when its ack_interval runs out."""
+    def __init__(self, hub, subscription):
+        self.hub = hub
+        self.subscription = subscription
+
+    def on_timer_task(self, event):
+        self.subscription.ack_timer = None
+        if self.subscription.link is not None and not self.subscription.closed.is_set():
+            self.hub._acknowledge(self.subscription)
@@ -1,19 +1,78 @@
 import json
+import time
 import logging
+import threading
+import collections
+from concurrent.futures import Future
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
+from protocols.amqp.reactor import ReactorThread
+from utils import metrics
+from utils.content_types import CONTENT_TYPE_JSON, CONTENT_TYPE_BINARY
+
+# Sender links a PooledConnection keeps open; reply topics are used once each, so the cache must not grow with them
+MAX_SENDER_LINKS = 64
+
+class SendError(Exception):
+    """Raised through a send future when the broker does not accept the message."""
+
+class JSONText(str):
+    """A str that already holds JSON, sent as the body without being encoded again."""
+
+def build_message(messages, reply_to = None, content_type = None, properties = None):
+    """
+    Binary bodies (bytes, bytearray, memoryview) are sent as they are, JSONText as it is, anything
+    else as JSON.
+    """
+    if isinstance(messages, (bytes, bytearray, memoryview)):
+        msg = Message(body=bytes(messages), content_type=content_type or CONTENT_TYPE_BINARY)
+    elif isinstance(messages, JSONText):
+        msg = Message(body=str(messages), content_type=content_type or CONTENT_TYPE_JSON)
+    else:
+        msg = Message(body=json.dumps(messages), content_type=content_type or CONTENT_TYPE_JSON)
+    msg.reply_to = reply_to
+    if properties:
+        msg.properties = properties
+    return msg
 
 class Sender:
-    def __init__(self):
-        pass
+    """
+    Sends messages to AMQP topics.
 
-    def send(self, server, topic, messages, reply_to = None):
-        container = Container(SendHandler(server, topic, messages, reply_to))
+    By default messages go through a shared ConnectionPool, which keeps one connection per
+    broker URL open and reuses sender links per topic. With pooled=False every call opens and
+    tears down its own Container, which was the original behaviour.
+    """
+    def __init__(self, pooled = True, pool = None):
+        self.pooled = pooled
+        self.pool = pool if pool is not None else (ConnectionPool.default() if pooled else None)
+
+    def send(self, server, topic, messages, reply_to = None, content_type = None, properties = None) -> Future:
+        """
+        Send `messages` as a JSON body, or as a binary body with `content_type` if it is bytes-like.
+        Returns a future resolved once the broker settles the message.
+        """
+        if self.pool is not None:
+            return self.pool.send(server, topic, build_message(messages, reply_to, content_type, properties))
+
+        future = Future()
+        handler = SendHandler(server, topic, messages, reply_to, content_type, properties)
+        start = time.perf_counter()
+        container = Container(handler)
         container.run()
+        if metrics.enabled:
+            # Connection setup included, which is most of it
+            metrics.histogram("amqp_send_seconds", "Send to acceptance by the broker",
+                              topic=metrics.topic_label(topic)).observe(time.perf_counter() - start)
+        if handler.confirmed == handler.total:
+            future.set_result(True)
+        else:
+            future.set_exception(SendError(f"Message to topic {topic} on server {server} was not accepted"))
+        return future
 
 class SendHandler(MessagingHandler):
-    def __init__(self, server, topic, messages, reply_to = None):
+    def __init__(self, server, topic, messages, reply_to = None, content_type = None, properties = None):
         super(SendHandler, self).__init__()
         self.server = server
         self.topic = topic
@@ -21,6 +80,8 @@ class SendHandler(MessagingHandler):
         self.confirmed = 0
         self.total = 1
         self.reply_to = reply_to
+        self.content_type = content_type
+        self.properties = properties
 
     def on_connection_error(self, event):
         logging.error(f"Connection error while sending messages to server: {self.server} for topic: {self.topic}")
@@ -37,9 +98,10 @@ class SendHandler(MessagingHandler):
     def on_sendable(self, event):
         logging.info(f"Agent sending messages to topic {self.topic}")
         try:
-            msg = Message(body=json.dumps(self.messages))
-            msg.reply_to = self.reply_to
+            msg = build_message(self.messages, self.reply_to, self.content_type, self.properties)
             event.sender.send(msg)
+            if metrics.enabled:
+                count_sent(self.topic, msg)
             logging.info("Agent sending msg to topic{}".format(self.topic))
             event.sender.close()
         except Exception as e:
@@ -48,7 +110,7 @@ class SendHandler(MessagingHandler):
     def on_rejected(self, event):
         logging.error("msg regected while sending msg to server: {} for topic: {}".format(self.server, self.topic))
         return super().on_rejected(event)
-        
+
     def on_accepted(self, event):
         logging.info("msg accepted in topic {}".format(self.topic))
         self.confirmed += 1
@@ -58,3 +120,175 @@ class SendHandler(MessagingHandler):
     def on_disconnected(self, event):
         logging.error("disconnected error while sending msg to server: {} for topic: {}".format(self.server, self.topic))
         self.sent = self.confirmed
+
+def count_sent(topic, msg):
+    topic = metrics.topic_label(topic)
+    metrics.counter("amqp_messages_sent_total", "Messages sent", topic=topic).inc()
+    metrics.counter("amqp_bytes_sent_total", "Bytes of the message bodies sent", topic=topic).inc(metrics.body_size(msg.body))
+
+class ConnectionPool:
+    """
+    One long-lived PooledConnection (and reactor thread) per broker URL.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> 'ConnectionPool':
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def connection(self, server) -> 'PooledConnection':
+        with self.lock:
+            conn = self.connections.get(server)
+            if conn is None or conn.closed:
+                conn = PooledConnection(server).start()
+                self.connections[server] = conn
+            return conn
+
+    def send(self, server, topic, msg: Message) -> Future:
+        return self.connection(server).send(topic, msg)
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for conn in connections:
+            conn.close()
+
+class PooledConnection(ReactorThread):
+    """
+    A single connection to one broker with a cached sender link per topic. At most
+    MAX_SENDER_LINKS links are kept: the least recently used idle one is closed to make room.
+
+    `send()` is thread safe: it queues the message and returns a future that the reactor
+    thread resolves when the broker accepts (True) or refuses (SendError) the delivery.
+    """
+    def __init__(self, server):
+        super(PooledConnection, self).__init__(server)
+        self.senders = collections.OrderedDict()  # topic -> sender link, least recently used first
+        self.pending = collections.defaultdict(collections.deque)
+        self.unsettled = {}
+        # Held while checking closed and queueing a send, and while setting closed: a send is
+        # either refused here or queued before _close, which the reactor then runs it after
+        self.send_lock = threading.Lock()
+
+    def send(self, topic, msg: Message) -> Future:
+        future = Future()
+        if metrics.enabled:
+            count_sent(topic, msg)
+            self._time(topic, future)
+        with self.send_lock:
+            if not self.closed:
+                self.call(self._enqueue, topic, msg, future)
+                return future
+        future.set_exception(SendError(f"Connection to server {self.server} is closed"))
+        return future
+
+    def _time(self, topic, future):
+        start = time.perf_counter()
+        latency = metrics.histogram("amqp_send_seconds", "Send to acceptance by the broker", topic=metrics.topic_label(topic))
+
+        def observe(future):
+            if not future.cancelled() and future.exception() is None:
+                latency.observe(time.perf_counter() - start)
+        future.add_done_callback(observe)
+
+    def _observe_queues(self):
+        metrics.gauge("amqp_send_queue_depth", "Messages waiting for link credit", server=self.server).set(
+            sum(len(queued) for queued in self.pending.values()))
+        metrics.gauge("amqp_send_unsettled", "Messages sent and not yet settled by the broker", server=self.server).set(
+            len(self.unsettled))
+
+    def _enqueue(self, topic, msg, future):
+        if self.closed:
+            # Queued before close() and run after it, pending was already drained
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SendError(f"Connection to server {self.server} is closed"))
+            return
+        self.pending[topic].append((msg, future))
+        sender = self.senders.get(topic)
+        if sender is None:
+            self._evict()
+            sender = self.container.create_sender(self.conn, topic)
+            self.senders[topic] = sender
+        else:
+            self.senders.move_to_end(topic)
+        self._flush(sender)
+
+    def _evict(self):
+        """Close least recently used links with nothing queued or unsettled until there is room for one more."""
+        for topic, sender in list(self.senders.items()):
+            if len(self.senders) < MAX_SENDER_LINKS:
+                return
+            if self.pending.get(topic) or sender.unsettled:
+                continue
+            del self.senders[topic]
+            self.pending.pop(topic, None)
+            sender.close()
+
+    def _flush(self, sender):
+        queued = self.pending.get(sender.target.address)
+        while queued and sender.credit:
+            msg, future = queued.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            delivery = sender.send(msg)
+            self.unsettled[delivery] = future
+        if metrics.enabled:
+            self._observe_queues()
+
+    def on_sendable(self, event):
+        self._flush(event.sender)
+
+    def on_accepted(self, event):
+        future = self.unsettled.pop(event.delivery, None)
+        if future:
+            future.set_result(True)
+        if metrics.enabled:
+            self._observe_queues()
+
+    def on_rejected(self, event):
+        logging.error(f"msg rejected while sending msg to server: {self.server} for topic: {event.link.target.address}")
+        self._fail(event.delivery, "rejected")
+
+    def on_released(self, event):
+        self._fail(event.delivery, "released")
+
+    def _fail(self, delivery, reason):
+        future = self.unsettled.pop(delivery, None)
+        if future:
+            future.set_exception(SendError(f"Message {reason} by server {self.server}"))
+
+    def on_disconnected(self, event):
+        logging.error(f"disconnected from server: {self.server}, dropping {len(self.unsettled)} unsettled messages")
+        for future in self.unsettled.values():
+            future.set_exception(SendError(f"Disconnected from server {self.server}"))
+        self.unsettled.clear()
+        # Links are recreated on demand once proton has reconnected
+        for sender in self.senders.values():
+            sender.close()
+        self.senders.clear()
+        for topic in [topic for topic, queued in self.pending.items() if not queued]:
+            del self.pending[topic]
+        for topic in self.pending:
+            self.senders[topic] = self.container.create_sender(self.conn, topic)
+
+    def _close(self):
+        with self.send_lock:
+            self.closed = True
+        for queued in self.pending.values():
+            while queued:
+                msg, future = queued.popleft()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(SendError(f"Connection to server {self.server} is closed"))
+        for future in self.unsettled.values():
+            future.set_exception(SendError(f"Connection to server {self.server} is closed"))
+        self.unsettled.clear()
+        super(PooledConnection, self)._close()
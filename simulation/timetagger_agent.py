@@ -0,0 +1,244 @@
+"""
+Simulated timetagger agent, to exercise the client and the GUI without hardware:
+
+    python -m simulation.timetagger_agent --broker amqp://localhost:5672/ --rate 1e7 --pairs 1:2
+
+It announces its capabilities on topic:///capabilities like a real agent, answers specifications
+on topic://{endpoint}/specifications with a receipt and streams one result per White Rabbit
+second on topic://{measurement_id}/results, until the schedule is done or it is interrupted.
+"""
+import argparse
+import json
+import logging
+import pickle
+import threading
+import time
+import numpy as np
+from analysis.coincidences import calculate_coincidences
+from protocols.amqp.receive import Receiver
+from protocols.amqp.send import Sender
+from utils.broker import CAPABILITY_TIMEOUT, RECEIVER_CAPABILITY_TOPIC
+from utils.data_compression import compress_data_blosc
+from utils.message import CONTENT_TYPE_PICKLE, Message
+
+PS_PER_SECOND = 1e12
+# Results sent and not yet acknowledged by the broker, per measurement
+MAX_IN_FLIGHT = 4
+CODEC_BLOSC = "blosc"
+CODEC_FRAMES = "frames"
+
+class TimetagSimulator:
+    """
+    Timetags (ps, float64, sorted) of one White Rabbit second per channel: background tags are a
+    Poisson process of `rate` tags/s, and each (channel_1, channel_2) of `pairs` adds a Poisson
+    process of `pair_rate` pairs/s, tagged on channel_2 `delay_ps` later with a gaussian jitter
+    of `jitter_ps`, which gives the coincidence peak.
+    """
+    def __init__(self, rate=1e6, pairs=(), pair_rate=1e4, delay_ps=0.0, jitter_ps=50.0, seed=None):
+        self.rate = rate
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.pair_rate = pair_rate
+        self.delay_ps = delay_ps
+        self.jitter_ps = jitter_ps
+        self.rng = np.random.default_rng(seed)
+
+    def uniform_sorted(self, count):
+        """`count` sorted uniform times (whole ps) of one second, as normalised sums of exponentials."""
+        times = self.rng.standard_exponential(count + 1)
+        # In place, the arrays of a busy channel are tens of MB
+        np.cumsum(times, out=times)
+        scale = PS_PER_SECOND / times[-1]
+        times = times[:-1]
+        times *= scale
+        return np.rint(times, out=times)
+
+    def second(self, channels) -> dict:
+        """{channel: timetags} of one second for `channels`."""
+        data = {channel: self.uniform_sorted(self.rng.poisson(self.rate)) for channel in channels}
+        for channel_1, channel_2 in self.pairs:
+            if channel_1 not in data or channel_2 not in data:
+                continue
+            starts = self.uniform_sorted(self.rng.poisson(self.pair_rate))
+            delayed = np.sort(np.rint(starts + self.delay_ps + self.rng.normal(0, self.jitter_ps, starts.size)))
+            data[channel_1] = merge_sorted(data[channel_1], starts)
+            data[channel_2] = merge_sorted(data[channel_2], delayed)
+        return data
+
+def merge_sorted(timetags, extra):
+    """Merge the sorted `extra` into the sorted `timetags`, one copy instead of a sort."""
+    return np.insert(timetags, np.searchsorted(timetags, extra), extra)
+
+class SimulatedTimetaggerAgent:
+    """
+    Agent of one simulated timetagger, with the capabilities
+        measure-timetags: {channel: {wr_time: compress_data_blosc(timetags)}} per second, in a
+            pickled body like the real agent (or framed timetags with codec=CODEC_FRAMES),
+        measure-count-rate: {channel: tags in the second},
+        measure-coincidences: coincidence histogram of two channels for each second.
+    Results are paced at `speed` simulated seconds per second, 0 for as fast as possible.
+    """
+    def __init__(self, broker_url, name="Alice", endpoint=None, simulator: TimetagSimulator = None, speed=1.0,
+                 codec=CODEC_BLOSC, announce_interval=CAPABILITY_TIMEOUT / 3):
+        self.broker_url = broker_url
+        self.name = name
+        self.endpoint = endpoint or f"/simulated/tt/{name}"
+        self.simulator = simulator or TimetagSimulator()
+        self.speed = speed
+        self.codec = codec
+        self.announce_interval = announce_interval
+        self.sender = Sender()
+        self.receiver = None
+        self.stopped = threading.Event()
+        self.measurements = {}  # measurement_id -> stop Event of its stream
+        self.lock = threading.Lock()
+
+    def capabilities(self) -> list:
+        channels = {"type": "string", "description": "channels separated by |, e.g. 1|2"}
+        capabilities = [
+            ("measure-timetags", f"TimetagsMeasurement{self.name}", {"channels": channels}),
+            ("measure-count-rate", f"CountRate{self.name}", {"channels": channels}),
+            ("measure-coincidences", f"Coincidences{self.name}", {
+                "channels": {"type": "array", "maxItems": 2, "items": {"type": "object", "properties": {
+                    "channel": {"type": "string"}, "endpoint": {"type": "string"}}}},
+                "peak0": {"type": "number"}, "bins": {"type": "integer"}, "range_ns": {"type": "number"}}),
+        ]
+        return [{
+            "capability": capability,
+            "endpoint": self.endpoint,
+            "capabilityName": capability_name,
+            "label": f"Simulated timetagger {self.name}",
+            "parameters_schema": {"type": "object", "properties": properties},
+            "resultSchema": {},
+        } for capability, capability_name, properties in capabilities]
+
+    def start(self) -> 'SimulatedTimetaggerAgent':
+        self.stopped.clear()
+        self.receiver = Receiver(on_message_callback=self.on_specification)
+        self.receiver.start(self.broker_url, f"topic://{self.endpoint}/specifications").wait_ready(timeout=10)
+        threading.Thread(target=self.announce, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.receiver:
+            self.receiver.stop()
+        with self.lock:
+            for stopped in self.measurements.values():
+                stopped.set()
+
+    def announce(self):
+        while not self.stopped.is_set():
+            for capability in self.capabilities():
+                self.sender.send(self.broker_url, RECEIVER_CAPABILITY_TOPIC, capability)
+            self.stopped.wait(self.announce_interval)
+
+    def on_specification(self, event):
+        try:
+            specification = json.loads(event.message.body)
+            measurement_id = Message.calculate_measurement_id(specification)
+        except Exception as e:
+            logging.error(f"Invalid specification: {e}")
+            return
+        receipt = dict(specification)
+        receipt["receipt"] = specification.get("specification") or specification.get("interrupt")
+        self.sender.send(self.broker_url, event.message.reply_to, receipt)
+
+        with self.lock:
+            if "interrupt" in specification:
+                stopped = self.measurements.pop(measurement_id, None)
+                if stopped:
+                    stopped.set()
+                return
+            stopped = self.measurements[measurement_id] = threading.Event()
+        threading.Thread(target=self.run_measurement, args=(measurement_id, specification, stopped), daemon=True).start()
+
+    def run_measurement(self, measurement_id, specification, stopped):
+        topic = f"topic://{measurement_id}/results"
+        parameters = specification.get("parameters", {})
+        capability = specification.get("specification")
+        schedule = str(specification.get("schedule", ""))
+        # "now || stream" runs until interrupted, any other schedule gives `seconds` results
+        seconds = None if "stream" in schedule else int(parameters.get("seconds", 1))
+        channels = self.channels(capability, parameters)
+        logging.info(f"Simulating {capability} of channels {channels} on {topic}")
+
+        in_flight = []
+        start = time.time()
+        sent = 0
+        behind = False
+        while not stopped.is_set() and not self.stopped.is_set() and (seconds is None or sent < seconds):
+            wr_time = float(int(start) + sent)
+            body, content_type, properties = self.result(capability, parameters, channels, wr_time)
+            in_flight.append(self.sender.send(self.broker_url, topic, body, content_type=content_type, properties=properties))
+            sent += 1
+            if len(in_flight) > MAX_IN_FLIGHT:
+                in_flight.pop(0).result(timeout=60)
+            if self.speed:
+                delay = start + sent / self.speed - time.time()
+                if delay < -1 and not behind:
+                    behind = True
+                    logging.warning(f"Simulation of {topic} is falling behind real time, lower the rate or use --codec frames")
+                stopped.wait(max(delay, 0))
+        if not stopped.is_set():
+            self.sender.send(self.broker_url, topic, {"result": "ok", "resultValues": ["EOF_results"]})
+        with self.lock:
+            self.measurements.pop(measurement_id, None)
+
+    def channels(self, capability, parameters) -> list:
+        if capability == "measure-coincidences":
+            channels = [entry.get("channel") for entry in parameters.get("channels", [])][:2]
+        else:
+            channels = parameters.get("channels", "1")
+            if isinstance(channels, str):
+                channels = channels.split("|")
+        # Integer channels like the real agent, pairs are configured with them
+        return [int(channel) if str(channel).strip().isdigit() else channel for channel in channels if str(channel).strip()]
+
+    def result(self, capability, parameters, channels, wr_time):
+        """Body, content type and properties of the result of one second."""
+        data = self.simulator.second(channels)
+        if capability == "measure-count-rate":
+            return {"result": "ok", "resultValues": [{str(channel): int(tags.size) for channel, tags in data.items()}]}, None, None
+        if capability == "measure-coincidences":
+            (histo_vals, bin_edges), peak = calculate_coincidences(
+                data[channels[0]], data[channels[1]], peak0=float(parameters.get("peak0") or 0),
+                range_ns=float(parameters.get("range_ns") or 1), bins=int(parameters.get("bins") or 50))
+            return {"result": "ok", "resultValues": [{"histo_vals": histo_vals.tolist(), "bin_edges": bin_edges.tolist(),
+                                                      "peak": float(peak), "wr_time": wr_time}]}, None, None
+        result = {"result": "ok", "resultValues": [{channel: {wr_time: tags} for channel, tags in data.items()}]}
+        if self.codec == CODEC_FRAMES:
+            return Message.encode_timetags_result(result)
+        result["resultValues"] = [{channel: {wr_time: compress_data_blosc(tags)} for channel, tags in data.items()}]
+        return pickle.dumps(result), CONTENT_TYPE_PICKLE, None
+
+def parse_pair(text):
+    channel_1, channel_2 = text.split(":")
+    return int(channel_1), int(channel_2)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default="amqp://localhost:5672/")
+    parser.add_argument("--name", default="Alice", help="agent name, the endpoint is /simulated/tt/<name> by default")
+    parser.add_argument("--endpoint")
+    parser.add_argument("--rate", type=float, default=1e6, help="background tags per second per channel")
+    parser.add_argument("--pairs", type=parse_pair, nargs="*", default=[(1, 2)], help="correlated channels, e.g. 1:2 3:4")
+    parser.add_argument("--pair-rate", type=float, default=1e4, help="correlated pairs per second per pair of channels")
+    parser.add_argument("--delay-ps", type=float, default=0.0, help="delay of the second channel of a pair")
+    parser.add_argument("--jitter-ps", type=float, default=50.0, help="standard deviation of the pair delay")
+    parser.add_argument("--speed", type=float, default=1.0, help="simulated seconds per second, 0 for as fast as possible")
+    parser.add_argument("--codec", choices=(CODEC_BLOSC, CODEC_FRAMES), default=CODEC_BLOSC)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = TimetagSimulator(args.rate, args.pairs, args.pair_rate, args.delay_ps, args.jitter_ps, args.seed)
+    agent = SimulatedTimetaggerAgent(args.broker, args.name, args.endpoint, simulator, args.speed, args.codec).start()
+    logging.info(f"Simulated timetagger {agent.endpoint} running, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        agent.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 import time
+import heapq
 import threading
 import json
-from utils.message import Message
+import zlib
+import uuid
+import collections
+from utils.message import Message, CONTENT_TYPE_JSON, CONTENT_TYPE_JSON_ZLIB
 import logging
+from utils import metrics
 from protocols.amqp.receive import Receiver
-from protocols.amqp.send import Sender
+from protocols.amqp.send import Sender, JSONText
 
 CAPABILITY_TIMEOUT = 60
 CLEANUP_INTERVAL = 10
+# Snapshot versions whose changes are kept to answer delta requests
+CHANGE_HISTORY = 1000
 RECEIVER_CAPABILITY_TOPIC = "topic:///capabilities"
 RECEIVER_SPECIFICATIONS_TOPIC = "topic:///specifications"
 RECEIVER_GET_CAPABILITIES_TOPIC = "topic:///get_capabilities"
@@ -15,41 +22,174 @@ RECEIVER_GET_CAPABILITIES_TOPIC = "topic:///get_capabilities"
 # Configure logging
 #logging.basicConfig(level=logging.INFO)  # Set the desired logging level
 
+class CapabilitiesSnapshot:
+    """
+    Immutable view of the capabilities at one moment, with indexes by capability type and endpoint.
+    A new snapshot is built for every change and the old one is never modified, so readers use it
+    without any lock while writers carry on.
+    """
+    def __init__(self, version=0, capabilities=None, by_type=None, by_endpoint=None):
+        self.version = version
+        self.capabilities = capabilities if capabilities is not None else {}
+        self.by_type = by_type if by_type is not None else {}  # capability type -> {capability_id: capability}
+        self.by_endpoint = by_endpoint if by_endpoint is not None else {}  # endpoint -> {capability_id: capability}
+
+    def changed(self, added, removed) -> 'CapabilitiesSnapshot':
+        """
+        A new snapshot with the {capability_id: capability} `added` (or replaced) and the ids of
+        `removed` deleted. Only the index entries that change are copied.
+        """
+        capabilities = dict(self.capabilities)
+        by_type = dict(self.by_type)
+        by_endpoint = dict(self.by_endpoint)
+        copied = set()
+
+        def index_entry(index, name, key):
+            # Copy an inner dict the first time this change touches it
+            if (name, key) not in copied:
+                index[key] = dict(index.get(key, {}))
+                copied.add((name, key))
+            # Deleted when a replaced capability was the last of its key, this change owns the new one
+            return index.setdefault(key, {})
+
+        for capability_id in list(removed) + list(added):
+            old = capabilities.pop(capability_id, None)
+            if old is None:
+                continue
+            for index, name, key in ((by_type, "type", old.get("capability")), (by_endpoint, "endpoint", old.get("endpoint"))):
+                entry = index_entry(index, name, key)
+                entry.pop(capability_id, None)
+                if not entry:
+                    del index[key]
+        for capability_id, capability in added.items():
+            capabilities[capability_id] = capability
+            index_entry(by_type, "type", capability.get("capability"))[capability_id] = capability
+            index_entry(by_endpoint, "endpoint", capability.get("endpoint"))[capability_id] = capability
+        return CapabilitiesSnapshot(self.version + 1, capabilities, by_type, by_endpoint)
+
 class CapabilitiesManager:
+    """
+    Capabilities announced by the agents, forgotten `timeout` seconds after their last announcement.
+
+    Expiry uses a min-heap holding one deadline per capability: a re-announcement only moves the
+    deadline forward, and the cleanup pops the entries that are due, so its cost depends on what
+    expires rather than on the number of agents.
+
+    Reads go to the current CapabilitiesSnapshot without locking. A re-announcement with unchanged
+    content does not change it, and changes are only published into a new snapshot by the next
+    read, so a burst of new agents costs one copy rather than one per agent. The copy is made
+    under publish_lock only, which writers never take: announcements are not held up by it.
+    """
     def __init__(self, timeout, cleanup_interval):
-        self.capabilities = {}
-        self.last_update = {}
+        self._snapshot = CapabilitiesSnapshot()
+        self.pending_added = {}  # changes not published in a snapshot yet
+        self.pending_removed = set()
+        self.publishing_added = {}  # changes being copied into the next snapshot
+        self.publishing_removed = set()
+        # Versions restart from 0 with every manager, the epoch tells versions of different runs apart
+        self.epoch = uuid.uuid4().hex[:12]
+        self.changes = collections.deque(maxlen=CHANGE_HISTORY)  # (version, ids changed by it)
+        self.deadlines = {}  # capability_id -> time after which it is stale
+        self.expiry_heap = []  # (deadline when pushed, capability_id), one entry per capability
         self.timeout = timeout
         self.cleanup_interval = cleanup_interval
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # pending and publishing changes, deadlines
+        self.publish_lock = threading.Lock()  # snapshot and changes
         
         # Start the thread to periodically remove stale capabilities
         self.cleanup_thread = threading.Thread(target=self._run_cleanup, daemon=True)
         self.cleanup_thread.start()
 
-    def add_capability(self, capability_id, capability_msg):        
+    @property
+    def snapshot(self) -> CapabilitiesSnapshot:
+        if self.pending_added or self.pending_removed:
+            with self.publish_lock:
+                self._publish()
+        return self._snapshot
+
+    def _publish(self):
+        """Publish the pending changes in a new snapshot, with publish_lock held."""
         with self.lock:
-            if capability_id not in self.capabilities:
-                self.capabilities[capability_id] = {}
+            if not self.pending_added and not self.pending_removed:
+                return
+            added, removed = self.publishing_added, self.publishing_removed = self.pending_added, self.pending_removed
+            self.pending_added = {}
+            self.pending_removed = set()
+        snapshot = self._snapshot.changed(added, removed)
+        self.changes.append((snapshot.version, frozenset(added) | removed))
+        with self.lock:
+            self._snapshot = snapshot
+            self.publishing_added = {}
+            self.publishing_removed = set()
+
+    def changes_since(self, version):
+        """
+        Returns:
+            tuple: current snapshot, and the ids added, changed or removed since `version`, or None
+            if that version is not known anymore (or was never published).
+        """
+        with self.publish_lock:
+            self._publish()
+            snapshot = self._snapshot
+            changes = list(self.changes)
+        if version == snapshot.version:
+            return snapshot, set()
+        if version > snapshot.version or not changes or changes[0][0] > version + 1:
+            return snapshot, None
+        changed = set()
+        for changed_version, ids in changes:
+            if changed_version > version:
+                changed |= ids
+        return snapshot, changed
 
-            # Add the capability to the dictionary using its ID
-            self.capabilities[capability_id] = capability_msg
-            
-            # Update the last update time
-            self.last_update[capability_id] = time.time()
+    @property
+    def capabilities(self) -> dict:
+        """{capability_id: capability} of the current snapshot, not to be modified."""
+        return self.snapshot.capabilities
+
+    def add_capability(self, capability_id, capability_msg):
+        """Add or refresh a capability, raises ValueError if it cannot be indexed."""
+        if not isinstance(capability_msg, dict):
+            raise ValueError(f"Capability {capability_id} is not an object")
+        for field in ("capability", "endpoint"):
+            if not isinstance(capability_msg.get(field), (str, type(None))):
+                raise ValueError(f"Capability {capability_id} has a non-string {field}")
+        deadline = time.time() + self.timeout
+        with self.lock:
+            if capability_id not in self.deadlines:
+                heapq.heappush(self.expiry_heap, (deadline, capability_id))
+            self.deadlines[capability_id] = deadline
+            if self._current(capability_id) != capability_msg:
+                self.pending_added[capability_id] = capability_msg
+                self.pending_removed.discard(capability_id)
+
+    def _current(self, capability_id):
+        """The capability as the next snapshot will hold it, None if it will not, with self.lock held."""
+        for added, removed in ((self.pending_added, self.pending_removed), (self.publishing_added, self.publishing_removed)):
+            if capability_id in added:
+                return added[capability_id]
+            if capability_id in removed:
+                return None
+        return self._snapshot.capabilities.get(capability_id)
 
     def remove_stale_capabilities(self):
         current_time = time.time()
         ids_to_remove = []
         
         with self.lock:
-            for endpoint, last_time in self.last_update.items():
-                if current_time - last_time > self.timeout:
-                    ids_to_remove.append(endpoint)
-            
-            for endpoint in ids_to_remove:
-                del self.capabilities[endpoint]
-                del self.last_update[endpoint]
+            while self.expiry_heap and self.expiry_heap[0][0] < current_time:
+                _, capability_id = heapq.heappop(self.expiry_heap)
+                deadline = self.deadlines[capability_id]
+                if deadline < current_time:
+                    del self.deadlines[capability_id]
+                    ids_to_remove.append(capability_id)
+                else:
+                    # Announced again since this entry was pushed
+                    heapq.heappush(self.expiry_heap, (deadline, capability_id))
+            for capability_id in ids_to_remove:
+                self.pending_added.pop(capability_id, None)
+                self.pending_removed.add(capability_id)
+        return ids_to_remove
 
     def _run_cleanup(self):
         while True:
@@ -58,7 +198,18 @@ class CapabilitiesManager:
 
 
     def get_capability(self, capability_id):
-        return self.capabilities.get(capability_id)
+        return self.snapshot.capabilities.get(capability_id)
+
+    def get_capabilities_by_type(self, capability_types) -> dict:
+        """{capability_id: capability} of the given capability types."""
+        snapshot = self.snapshot
+        capabilities = {}
+        for capability_type in capability_types:
+            capabilities.update(snapshot.by_type.get(capability_type, {}))
+        return capabilities
+
+    def get_capabilities_by_endpoint(self, endpoint) -> dict:
+        return dict(self.snapshot.by_endpoint.get(endpoint, {}))
 
 
 
@@ -67,13 +218,17 @@ class Broker():
         self.broker_url = broker_url
         self.capability_manager = CapabilitiesManager(CAPABILITY_TIMEOUT, CLEANUP_INTERVAL)
         self.sender = Sender()
+        # Serialized get_capabilities replies of the current snapshot, by (request kind, types, compress)
+        self.reply_cache = {}
+        self.reply_cache_version = None
+        self.reply_cache_lock = threading.Lock()
     def start(self):
         self.receiver_capabilities = Receiver(on_message_callback=self.receiver_capabilities_on_message_callback)
         self.receiver_specifications = Receiver(on_message_callback=self.receiver_specifications_on_message_callback)
         self.receiver_get_capabilities = Receiver(on_message_callback=self.receiver_get_capabilities_on_message_callback)
-        threading.Thread(target=self.receiver_capabilities.receive_event, args=(self.broker_url, RECEIVER_CAPABILITY_TOPIC)).start()
-        threading.Thread(target=self.receiver_specifications.receive_event, args=(self.broker_url, RECEIVER_SPECIFICATIONS_TOPIC)).start()
-        threading.Thread(target=self.receiver_get_capabilities.receive_event, args=(self.broker_url, RECEIVER_GET_CAPABILITIES_TOPIC)).start()
+        self.receiver_capabilities.start(self.broker_url, RECEIVER_CAPABILITY_TOPIC)
+        self.receiver_specifications.start(self.broker_url, RECEIVER_SPECIFICATIONS_TOPIC)
+        self.receiver_get_capabilities.start(self.broker_url, RECEIVER_GET_CAPABILITIES_TOPIC)
 
     def receiver_capabilities_on_message_callback(self, event):
         try:
@@ -81,8 +236,12 @@ class Broker():
             message =json.loads(event.message.body)
             capability_id = Message.calculate_capability_id(message=message)
             capability = message
-            logging.info(f"recived capability: {capability}")
+            logging.info("recived capability: %s", capability)
             self.capability_manager.add_capability(capability_id, capability)
+            if metrics.enabled:
+                metrics.counter("broker_capability_announcements_total", "Capability announcements received").inc()
+                metrics.gauge("broker_capabilities", "Capabilities known, stale ones until the next cleanup").set(
+                    len(self.capability_manager.deadlines))
         except Exception as e:
             logging.error(f"Error processing message: {e}")
     
@@ -92,15 +251,127 @@ class Broker():
             message =json.loads(event.message.body)
             spec_endpoint = message["endpoint"]
             target_topic = f'topic://{spec_endpoint}/specifications'
-            self.sender.send(self.broker_url, topic = target_topic, messages= message, reply_to=reply_to)
-            logging.info(f"Redirected specification to {target_topic}: {message}")
+            start = time.perf_counter()
+            future = self.sender.send(self.broker_url, topic = target_topic, messages= message, reply_to=reply_to)
+            if metrics.enabled:
+                self._time_forward(target_topic, start, future)
+            logging.info("Redirected specification to %s: %s", target_topic, message)
         except Exception as e:
             logging.error(f"Error processing message: {e}")
 
     def receiver_get_capabilities_on_message_callback(self, event):
         try:
             target_topic = event.message.reply_to
-            self.sender.send(self.broker_url, topic = target_topic, messages= self.capability_manager.capabilities)
+            try:
+                request = Message.decode_json_body(event.message.body, event.message.content_type)
+            except (TypeError, ValueError):
+                request = None
+            start = time.perf_counter()
+            body, content_type = self.capabilities_reply(request if isinstance(request, dict) else None)
+            if metrics.enabled:
+                metrics.histogram("broker_capabilities_reply_seconds", "Building (or reusing) a get_capabilities reply").observe(
+                    time.perf_counter() - start)
+            self.sender.send(self.broker_url, topic = target_topic, messages= body, content_type= content_type)
         except Exception as e:
             logging.error(f"Error processing message: {e}")
 
+    def _time_forward(self, target_topic, start, future):
+        topic = metrics.topic_label(target_topic)
+        metrics.counter("broker_specifications_forwarded_total", "Specifications forwarded to their agent", topic=topic).inc()
+        latency = metrics.histogram("broker_forward_seconds", "Specification received to accepted by the broker on the agent topic",
+                                    topic=topic)
+
+        def observe(future):
+            if not future.cancelled() and future.exception() is None:
+                latency.observe(time.perf_counter() - start)
+        future.add_done_callback(observe)
+
+    def capabilities_reply(self, request=None):
+        """
+        Serialized reply to a get_capabilities request.
+
+        A request is either empty (older clients), answered with the {capability_id: capability}
+        dict, or a JSON object with the optional fields:
+            capability_types (list): only return capabilities of these types.
+            version (str): version of the capabilities the client already holds.
+            compress (bool): zlib-compress the reply (CONTENT_TYPE_JSON_ZLIB).
+        answered with {"version", "status", "capabilities", "removed"}, where status is
+            "full": capabilities holds all the (matching) capabilities,
+            "delta": capabilities holds the ones added or changed since `version`, and removed the
+                ids to drop,
+            "not_modified": nothing changed since `version`.
+        Full replies are serialized once per snapshot version and reused for every request.
+
+        Returns:
+            tuple: body and content type, as taken by Sender.send.
+        """
+        manager = self.capability_manager
+        if request is None:
+            snapshot = manager.snapshot
+            return self._cached_reply(snapshot, ("legacy", None, False), lambda: snapshot.capabilities)
+
+        capability_types = request.get("capability_types")
+        capability_types = tuple(sorted(capability_types)) if capability_types else None
+        compress = bool(request.get("compress"))
+        version = self._parse_version(request.get("version"))
+        if version is None:
+            snapshot, changed = manager.snapshot, None
+        else:
+            snapshot, changed = manager.changes_since(version)
+
+        def matching():
+            if capability_types is None:
+                return snapshot.capabilities
+            capabilities = {}
+            for capability_type in capability_types:
+                capabilities.update(snapshot.by_type.get(capability_type, {}))
+            return capabilities
+
+        if changed is None:
+            return self._cached_reply(snapshot, ("full", capability_types, compress), lambda: {
+                "version": self._version_token(snapshot), "status": "full", "capabilities": matching(), "removed": []
+            })
+        if not changed:
+            reply = {"version": self._version_token(snapshot), "status": "not_modified", "capabilities": {}, "removed": []}
+        else:
+            capabilities = matching()
+            reply = {
+                "version": self._version_token(snapshot),
+                "status": "delta",
+                "capabilities": {cp_id: capabilities[cp_id] for cp_id in changed if cp_id in capabilities},
+                # Also lists changed capabilities of other types, clients drop them if they hold them
+                "removed": sorted(cp_id for cp_id in changed if cp_id not in capabilities),
+            }
+        return self._encode_reply(reply, compress)
+
+    def _cached_reply(self, snapshot, key, build):
+        with self.reply_cache_lock:
+            if self.reply_cache_version != snapshot.version:
+                self.reply_cache = {}
+                self.reply_cache_version = snapshot.version
+            cached = self.reply_cache.get(key)
+        if cached is None:
+            # Built outside the lock: two requests may serialize the same snapshot, both results are equal
+            cached = self._encode_reply(build(), key[2])
+            with self.reply_cache_lock:
+                if self.reply_cache_version == snapshot.version:
+                    self.reply_cache[key] = cached
+        return cached
+
+    def _encode_reply(self, reply, compress):
+        text = json.dumps(reply, separators=(",", ":"))
+        if compress:
+            return zlib.compress(text.encode()), CONTENT_TYPE_JSON_ZLIB
+        return JSONText(text), CONTENT_TYPE_JSON
+
+    def _version_token(self, snapshot):
+        return f"{self.capability_manager.epoch}:{snapshot.version}"
+
+    def _parse_version(self, token):
+        """Snapshot version of a token of this manager, None if missing or of another run."""
+        try:
+            epoch, version = str(token).split(":")
+            return int(version) if epoch == self.capability_manager.epoch else None
+        except ValueError:
+            return None
+
@@ -0,0 +1,7 @@
+# Content types of the AMQP message bodies, kept free of imports so that the transport
+# (protocols.amqp) can use them without pulling in numpy and blosc through utils.message
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_BINARY = "application/octet-stream"
+CONTENT_TYPE_PICKLE = "application/x-python-pickle"
+CONTENT_TYPE_TIMETAGS = "application/x-timetag-frames"
+CONTENT_TYPE_JSON_ZLIB = "application/x-json-zlib"
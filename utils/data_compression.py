@@ -4,6 +4,8 @@ import numpy as np
 import blosc
 import pickle
 import base64
+import struct
+from utils import metrics
 
 def compare_data_structures(data1, data2):
     """
@@ -59,6 +61,7 @@ def compress_data_blosc(data):
     compressed_data = blosc.compress(serialized_data, typesize=8, clevel=9)  # typesize=8 for double precision
     return compressed_data
 
+@metrics.timed("decompress_seconds", "Decompressing timetags", count_bytes=True)
 def decompress_data_blosc(compressed_data):
     """
     Decompresses the data structure using blosc.
@@ -83,4 +86,208 @@ def decode_and_decompress_data(encoded_data):
     # Decompress and deserialize the data
     serialized_data = blosc.decompress(compressed_data)
     data = pickle.loads(serialized_data)
-    return data
\ No newline at end of file
+    return data
+
+
+# Framed timetag payloads: the arrays of a {channel: {wrt: ndarray}} structure are compressed
+# straight from their buffers with a typed blosc shuffle, no pickle involved. Layout:
+#   header:  magic, number of frames
+#   frame:   codec, channel kind, wrt kind, dtype length, channel length, wrt, items, compressed size,
+#            then the dtype string, the channel string and the payload of the codec
+FRAME_MAGIC = b"TTF1"
+FRAMES_HEADER = struct.Struct("<4sI")
+FRAME_HEADER = struct.Struct("<BBBBHdQQ")
+CODEC_BLOSC = 1
+CODEC_DELTA_BITSHUFFLE = 2
+
+KIND_INT = 0
+KIND_STR = 1
+KIND_FLOAT = 2
+
+def _encode_key(key):
+    if isinstance(key, (bool, np.bool_)):
+        raise TypeError(f"Unsupported key type: {type(key)}")
+    if isinstance(key, (int, np.integer)):
+        return KIND_INT, str(int(key)).encode()
+    if isinstance(key, str):
+        return KIND_STR, key.encode()
+    raise TypeError(f"Unsupported channel type: {type(key)}")
+
+def _decode_key(kind, raw):
+    return int(raw) if kind == KIND_INT else raw.decode()
+
+# Timetag arrays are plain numbers: anything else (object, structured, ...) would have blosc
+# write raw bytes into pointers or fields, so it is refused on both ends
+FRAME_ITEMSIZES = {"i": (1, 2, 4, 8), "u": (1, 2, 4, 8), "f": (2, 4, 8)}
+
+def _check_dtype(dtype):
+    """Returns the dtype if timetag frames can hold it, raises ValueError otherwise."""
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError as e:
+        raise ValueError(f"Invalid timetag dtype {dtype!r}: {e}") from e
+    if dtype.itemsize not in FRAME_ITEMSIZES.get(dtype.kind, ()):
+        raise ValueError(f"Unsupported timetag dtype {dtype}, only integer and float numbers can be framed")
+    return dtype
+
+def compress_array_blosc(array, clevel=5, cname="blosclz", shuffle=blosc.SHUFFLE):
+    """
+    Compresses the buffer of a numpy array with blosc, shuffling with the array item size.
+    """
+    array = np.ascontiguousarray(array)
+    if array.nbytes > blosc.BLOSC_MAX_BUFFERSIZE:
+        raise ValueError(f"Array of {array.nbytes} bytes is larger than the blosc limit")
+    return blosc.compress_ptr(array.__array_interface__['data'][0], array.size, typesize=array.itemsize,
+                              clevel=clevel, shuffle=shuffle, cname=cname)
+
+def decompress_array_blosc(compressed, out):
+    """
+    Decompresses a compress_array_blosc buffer straight into the preallocated array `out`.
+    """
+    # Uncompressed size from the blosc header: version, versionlz, flags, typesize, nbytes
+    nbytes = struct.unpack_from("<I", compressed, 4)[0]
+    if not out.flags.c_contiguous or nbytes != out.nbytes:
+        raise ValueError(f"Output array of {out.nbytes} bytes does not fit {nbytes} decompressed bytes")
+    blosc.decompress_ptr(compressed, out.__array_interface__['data'][0])
+    return out
+
+# Delta codec: header of the payload, then the blosc compressed deltas
+DELTA_HEADER = struct.Struct("<BBq")
+DELTA_NATIVE = 0  # integer array, deltas of its values
+DELTA_INTEGRAL_FLOAT = 1  # float array holding exact integers, deltas of the integer values
+DELTA_FLOAT_BITS = 2  # any other float array, deltas of the bit patterns
+DELTA_WIDTHS = (np.int8, np.int16, np.int32, np.int64)
+
+def _delta_values(array):
+    """Lossless int64 representation of the array and the mode to restore it."""
+    if array.dtype.kind in "iu":
+        return array.astype(np.int64, copy=False) if array.dtype.itemsize < 8 else array.view(np.int64), DELTA_NATIVE
+    if array.dtype.kind != "f":
+        raise TypeError(f"Delta codec does not support dtype {array.dtype}")
+    # Picosecond timetags are usually whole numbers: keep their integer deltas when it is exact
+    if array.dtype.itemsize == 8 and np.all(np.abs(array) <= 2 ** 53):
+        as_int = array.astype(np.int64)
+        if np.array_equal(as_int, array) and not np.any(np.signbit(array[as_int == 0])):
+            return as_int, DELTA_INTEGRAL_FLOAT
+    bits = array.view(np.int64 if array.dtype.itemsize == 8 else np.int32 if array.dtype.itemsize == 4 else np.int16)
+    return bits.astype(np.int64, copy=False), DELTA_FLOAT_BITS
+
+def compress_array_delta(array, clevel=5, cname="lz4"):
+    """
+    Delta-encodes a (typically sorted) 1-d array, stores the deltas with the smallest integer width
+    that holds them and compresses them with blosc bitshuffle. Lossless for integer and float arrays.
+    """
+    values, mode = _delta_values(np.ascontiguousarray(array))
+    first = int(values[0]) if values.size else 0
+    deltas = np.diff(values)  # int64 arithmetic wraps around, which the cumulative sum undoes
+    width = DELTA_WIDTHS[-1]
+    if deltas.size:
+        low, high = deltas.min(), deltas.max()
+        width = next(w for w in DELTA_WIDTHS if np.iinfo(w).min <= low and high <= np.iinfo(w).max)
+    compressed = compress_array_blosc(deltas.astype(width, copy=False), clevel=clevel, cname=cname, shuffle=blosc.BITSHUFFLE)
+    return DELTA_HEADER.pack(mode, np.dtype(width).itemsize, first) + compressed
+
+def decompress_array_delta(payload, dtype, items):
+    """
+    Decompresses a compress_array_delta payload into a new array of `items` elements of `dtype`.
+    """
+    mode, width, first = DELTA_HEADER.unpack_from(payload, 0)
+    dtype = np.dtype(dtype)
+    values = np.empty(items, dtype=np.int64)
+    if items:
+        deltas = decompress_array_blosc(payload[DELTA_HEADER.size:], np.empty(items - 1, dtype=np.dtype(f"<i{width}")))
+        values[0] = first
+        np.cumsum(deltas, dtype=np.int64, out=values[1:])
+        values[1:] += first
+    if mode == DELTA_NATIVE:
+        return values.astype(dtype, copy=False) if dtype.itemsize < 8 else values.view(dtype)
+    if mode == DELTA_INTEGRAL_FLOAT:
+        return values.astype(dtype)
+    return values.astype(np.dtype(f"<i{dtype.itemsize}")).view(dtype)
+
+def encode_array(array, codec=CODEC_BLOSC, clevel=5, cname=None):
+    """Payload of one frame for the given codec id."""
+    if codec == CODEC_BLOSC:
+        return compress_array_blosc(array, clevel=clevel, cname=cname or "blosclz")
+    if codec == CODEC_DELTA_BITSHUFFLE:
+        return compress_array_delta(array, clevel=clevel, cname=cname or "lz4")
+    raise ValueError(f"Unknown timetag codec: {codec}")
+
+def decode_array(codec, payload, dtype, items):
+    """Array of one frame, decoded according to the codec id stored in the frame."""
+    dtype = _check_dtype(dtype)
+    if codec == CODEC_BLOSC:
+        return decompress_array_blosc(payload, np.empty(items, dtype=dtype))
+    if codec == CODEC_DELTA_BITSHUFFLE:
+        return decompress_array_delta(payload, dtype, items)
+    raise ValueError(f"Unknown timetag codec: {codec}")
+
+def pack_timetags(data, codec=CODEC_BLOSC, clevel=5, cname=None):
+    """
+    Compresses a {channel: {wrt: ndarray}} structure into one framed buffer without pickling.
+    Channels may be int or str, wrt keys int or float. The codec id is stored in every frame, so
+    unpack_timetags needs no option; use CODEC_DELTA_BITSHUFFLE for sorted timetags.
+    """
+    parts = [b""]
+    frames = 0
+    for channel, chunks in data.items():
+        channel_kind, channel_raw = _encode_key(channel)
+        for wrt, array in chunks.items():
+            array = np.asarray(array)
+            if array.ndim != 1:
+                raise ValueError(f"Only 1-d arrays can be framed, got shape {array.shape} for channel {channel}")
+            _check_dtype(array.dtype)
+            dtype_raw = array.dtype.str.encode()
+            compressed = encode_array(array, codec=codec, clevel=clevel, cname=cname)
+            wrt_kind = KIND_INT if isinstance(wrt, (int, np.integer)) else KIND_FLOAT
+            parts.append(FRAME_HEADER.pack(codec, channel_kind, wrt_kind, len(dtype_raw), len(channel_raw),
+                                           float(wrt), array.size, len(compressed)))
+            parts.extend((dtype_raw, channel_raw, compressed))
+            frames += 1
+    parts[0] = FRAMES_HEADER.pack(FRAME_MAGIC, frames)
+    return b"".join(parts)
+
+def iter_timetag_frames(buffer):
+    """
+    Yields (channel, wrt, array) for every frame of a pack_timetags buffer. With CODEC_BLOSC each
+    array is allocated once at its final size and blosc decompresses directly into it.
+    """
+    view = memoryview(buffer)
+    magic, frames = FRAMES_HEADER.unpack_from(view, 0)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a timetag frame buffer")
+    offset = FRAMES_HEADER.size
+    for _ in range(frames):
+        codec, channel_kind, wrt_kind, dtype_len, channel_len, wrt, items, size = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        dtype = _check_dtype(bytes(view[offset:offset + dtype_len]).decode())
+        offset += dtype_len
+        channel = _decode_key(channel_kind, bytes(view[offset:offset + channel_len]))
+        offset += channel_len
+        compressed = view[offset:offset + size]
+        offset += size
+        array = decode_array(codec, compressed, dtype, items)
+        yield channel, int(wrt) if wrt_kind == KIND_INT else wrt, array
+
+@metrics.timed("decompress_seconds", "Decompressing timetags", count_bytes=True)
+def unpack_timetags(buffer):
+    """
+    Decompresses a pack_timetags buffer back into a {channel: {wrt: ndarray}} structure.
+    """
+    data = {}
+    for channel, wrt, array in iter_timetag_frames(buffer):
+        data.setdefault(channel, {})[wrt] = array
+    return data
+
+def is_timetag_frames(buffer):
+    return bytes(buffer[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+@metrics.timed("decompress_seconds", "Decompressing timetags", count_bytes=True)
+def decompress_timetags_chunk(buffer):
+    """
+    Decompresses the timetags of one (channel, wrt) chunk of a result, whether it was sent as a
+    single framed array or with compress_data_blosc.
+    """
+    if is_timetag_frames(buffer):
+        return next(iter_timetag_frames(buffer))[2]
+    return decompress_data_blosc(bytes(buffer))
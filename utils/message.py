@@ -1,14 +1,60 @@
 import hashlib
+import json
+import functools
+import marshal
+import pickle
+import zlib
+from utils.data_compression import CODEC_BLOSC, pack_timetags, unpack_timetags
+from utils.content_types import (CONTENT_TYPE_JSON, CONTENT_TYPE_BINARY, CONTENT_TYPE_PICKLE, CONTENT_TYPE_TIMETAGS,
+                                 CONTENT_TYPE_JSON_ZLIB)
+
+# Application property holding the JSON fields of a message whose body is binary
+ENVELOPE_PROPERTY = "envelope"
+
+ID_SCHEME_LEGACY = "legacy"
+ID_SCHEME_CANONICAL = "canonical"
+# Distinct capabilities, and measurements, whose ID is remembered
+ID_CACHE_SIZE = 4096
+
+def canonical_json(value) -> str:
+    """Compact JSON with sorted keys: equal dicts give the same text whatever their key order."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def hash_attributes(attributes: list, id_scheme: str) -> str:
+    """SHA-256 hex digest of the attributes encoded with `id_scheme`."""
+    if id_scheme == ID_SCHEME_CANONICAL:
+        encoded = canonical_json(attributes)
+    else:
+        encoded = Message.combine_to_string(attributes)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+# Capabilities are announced, and measurements acknowledged, over and over with the same fields,
+# so their IDs are cached. Measurements are keyed by the marshal encoding of their parameters and
+# schedule: it is exact for JSON-like values and several times cheaper than the encoding it saves.
+# It follows dict order, so the same fields in another order only miss the cache.
+
+@functools.lru_cache(maxsize=ID_CACHE_SIZE)
+def cached_capability_id(endpoint: str, capability_name: str, id_scheme: str) -> str:
+    return hash_attributes([endpoint, capability_name], id_scheme)
+
+@functools.lru_cache(maxsize=ID_CACHE_SIZE)
+def cached_measurement_id(capability_id: str, marshalled_fields: bytes, id_scheme: str) -> str:
+    parameters, schedule = marshal.loads(marshalled_fields)
+    return hash_attributes([capability_id, parameters, schedule], id_scheme)
 
 class Message:
+    # How IDs are derived, must match the agents: ID_SCHEME_LEGACY (str() of the fields without
+    # spaces, depends on dict insertion order) or ID_SCHEME_CANONICAL (sorted-key compact JSON)
+    id_scheme = ID_SCHEME_LEGACY
+
     @staticmethod
     def calculate_capability_id(message):
         try:
             endpoint = message["endpoint"]
             capability_name = message["capabilityName"]
-            combined_string = Message.combine_to_string([endpoint, capability_name])
-            capability_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return capability_id
+            if type(endpoint) is str and type(capability_name) is str:
+                return cached_capability_id(endpoint, capability_name, Message.id_scheme)
+            return hash_attributes([endpoint, capability_name], Message.id_scheme)
         except KeyError as e:
             raise KeyError(f"Missing required field: {e}")
         except Exception as e:
@@ -20,9 +66,12 @@ class Message:
             capability_id = Message.calculate_capability_id(message)
             parameters = message["parameters"]
             schedule = message["schedule"]
-            combined_string = Message.combine_to_string([capability_id, parameters, schedule])
-            measurement_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return measurement_id
+            try:
+                marshalled_fields = marshal.dumps((parameters, schedule))
+            except ValueError:
+                # Not a JSON-like value, computed without the cache
+                return hash_attributes([capability_id, parameters, schedule], Message.id_scheme)
+            return cached_measurement_id(capability_id, marshalled_fields, Message.id_scheme)
         except KeyError as e:
             raise KeyError(f"Missing required field: {e}")
         except Exception as e:
@@ -34,9 +83,8 @@ class Message:
             measurement_id = Message.calculate_measurement_id(message)
             nonce = message["nonce"]
             timestamp = message["timestamp"]
-            combined_string = Message.combine_to_string([measurement_id, nonce, timestamp])
-            operation_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return operation_id
+            # Every operation has its own nonce, nothing to cache
+            return hash_attributes([measurement_id, nonce, timestamp], Message.id_scheme)
         except KeyError as e:
             raise KeyError(f"Missing required field: {e}")
         except Exception as e:
@@ -51,6 +99,57 @@ class Message:
             combined_string += att_str
         return combined_string
 
+    @staticmethod
+    def encode_timetags_result(result_msg, codec=CODEC_BLOSC):
+        """
+        Binary form of a result message whose resultValues hold one {channel: {wrt: ndarray}}
+        structure: the arrays become the raw framed body and the other fields an envelope property.
+
+        Returns:
+            tuple: body, content type and application properties, as taken by Sender.send.
+        """
+        envelope = {key: value for key, value in result_msg.items() if key != 'resultValues'}
+        body = pack_timetags(result_msg['resultValues'][0], codec=codec)
+        return body, CONTENT_TYPE_TIMETAGS, {ENVELOPE_PROPERTY: json.dumps(envelope)}
+
+    @staticmethod
+    def decode_body(body, content_type=None, properties=None):
+        """
+        Decode the body of an AMQP message according to its content type. Binary bodies without a
+        content type are assumed to be pickled, for senders that predate content types. Raw
+        CONTENT_TYPE_BINARY bodies are not messages and raise ValueError.
+        """
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        if content_type == CONTENT_TYPE_TIMETAGS:
+            message = json.loads((properties or {}).get(ENVELOPE_PROPERTY, "{}"))
+            message['resultValues'] = [unpack_timetags(body)]
+            return message
+        if content_type == CONTENT_TYPE_JSON_ZLIB:
+            return json.loads(zlib.decompress(body))
+        if content_type == CONTENT_TYPE_PICKLE or (content_type is None and isinstance(body, bytes)):
+            return pickle.loads(body)
+        if content_type == CONTENT_TYPE_BINARY:
+            raise ValueError(f"Cannot decode a raw binary ({CONTENT_TYPE_BINARY}) body of {len(body)} bytes into a message")
+        return json.loads(body)
+
+    @staticmethod
+    def decode_json_body(body, content_type=None):
+        """
+        Decode a JSON or zlib-compressed JSON body, for topics that anyone may publish to: other
+        content types raise ValueError, a body is never unpickled.
+        """
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        if content_type == CONTENT_TYPE_JSON_ZLIB:
+            try:
+                return json.loads(zlib.decompress(body))
+            except zlib.error as e:
+                raise ValueError(f"Invalid compressed body: {e}") from e
+        if content_type in (CONTENT_TYPE_JSON, None):
+            return json.loads(body)
+        raise ValueError(f"Unexpected content type {content_type}")
+
 # Test the Message class
 def test_message_class():
     message = {
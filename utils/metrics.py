@@ -0,0 +1,280 @@
+"""
+Counters, gauges and histograms of the hot paths of the client, the broker relay and the agents.
+
+Metrics are disabled by default and cost one attribute read (`metrics.enabled`) per instrumented
+call until they are enabled:
+
+    from utils import metrics
+    metrics.enable()
+    metrics.start_http_server(9100)  # Prometheus text on http://localhost:9100/metrics
+    metrics.log_periodically(60)  # and/or one JSON line per minute in the logs
+"""
+import re
+import json
+import bisect
+import logging
+import threading
+import time
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+enabled = False
+
+# Upper bounds (s) of the histogram buckets: 1 us to about 67 s in steps of 2x
+LATENCY_BUCKETS = tuple(1e-6 * 2 ** i for i in range(27))
+
+# Topics holding a measurement id or a random reply suffix become one label each
+ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+REPLY_TOPIC_PATTERN = re.compile(r"^topic://[A-Za-z0-9]{10}$")
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def reset(self):
+        self.value = 0
+
+    def export(self):
+        return self.value
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def reset(self):
+        self.value = 0
+
+    def export(self):
+        return self.value
+
+class Histogram:
+    """
+    Observations counted in fixed buckets, so memory stays constant; quantiles are interpolated
+    inside the bucket that holds them, which is exact to the bucket width, and kept within the
+    smallest and largest observations.
+    """
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+            self.count = 0
+            self.sum = 0.0
+            self.min = float("inf")
+            self.max = float("-inf")
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        with self.lock:
+            counts, count, smallest, largest = list(self.counts), self.count, self.min, self.max
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if index == len(self.buckets):
+                    return largest
+                lower = self.buckets[index - 1] if index else 0.0
+                value = lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+                return min(max(value, smallest), largest)
+            cumulative += bucket_count
+        return largest
+
+    def export(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class Registry:
+    """Metrics by name and labels, created on first use."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # (name, sorted label items) -> metric
+        self.descriptions = {}  # name -> help text
+
+    def get(self, metric_class, name, description, labels, **options):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = metric_class(**options)
+                    self.descriptions.setdefault(name, description)
+        return metric
+
+    def reset(self):
+        """Zero every metric. They stay registered, so references held by the instrumented code stay valid."""
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.reset()
+
+    def sorted_metrics(self) -> list:
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda item: item[0])
+
+    def snapshot(self) -> dict:
+        """{name: [{"labels": {...}, "value": ...}]}, histograms valued with count, sum, p50 and p99."""
+        exported = {}
+        for (name, labels), metric in self.sorted_metrics():
+            exported.setdefault(name, []).append({"labels": dict(labels), "value": metric.export()})
+        return exported
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for (name, labels), metric in self.sorted_metrics():
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.descriptions.get(name, '')}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_labels_text(labels)} {metric.value}")
+                continue
+            with metric.lock:
+                counts, count, total = list(metric.counts), metric.count, metric.sum
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels_text(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {total}")
+            lines.append(f"{name}_count{_labels_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+REGISTRY = Registry()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def counter(name, description="", **labels) -> Counter:
+    return REGISTRY.get(Counter, name, description, labels)
+
+def gauge(name, description="", **labels) -> Gauge:
+    return REGISTRY.get(Gauge, name, description, labels)
+
+def histogram(name, description="", buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+    return REGISTRY.get(Histogram, name, description, labels, buckets=buckets)
+
+def reset():
+    REGISTRY.reset()
+
+def snapshot() -> dict:
+    return REGISTRY.snapshot()
+
+def prometheus_text() -> str:
+    return REGISTRY.prometheus_text()
+
+@lru_cache(maxsize=1024)
+def topic_label(topic) -> str:
+    """`topic` with measurement ids and random reply topics folded, to bound the label values."""
+    topic = str(topic)
+    if REPLY_TOPIC_PATTERN.match(topic):
+        return "topic://{reply}"
+    return ID_PATTERN.sub("{id}", topic)
+
+def body_size(body) -> int:
+    """Size of an AMQP message body: bytes for binary bodies, characters for text ones."""
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+def timed(name, description="", count_bytes=False):
+    """
+    Decorator observing the duration of every call in the histogram `name`, labelled with the
+    function name, and with count_bytes the size of the first argument in `<name>_input_bytes_total`.
+    """
+    def decorate(function):
+        labels = {"function": function.__name__}
+        seconds = histogram(name, description, **labels)
+        input_bytes = counter(f"{name.removesuffix('_seconds')}_input_bytes_total", f"Input bytes of {name}", **labels) if count_bytes else None
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds.observe(time.perf_counter() - start)
+                if input_bytes is not None and args:
+                    input_bytes.inc(body_size(args[0]))
+        return timed_function
+    return decorate
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") == "/metrics":
+            body, content_type = prometheus_text().encode(), "text/plain; version=0.0.4"
+        elif self.path.rstrip("/") == "/metrics.json":
+            body, content_type = json.dumps(snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+def start_http_server(port, host="") -> ThreadingHTTPServer:
+    """Serve /metrics (Prometheus text) and /metrics.json from a daemon thread, enabling metrics."""
+    enable()
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+def log_periodically(interval=60.0, level=logging.INFO) -> threading.Event:
+    """Log the JSON snapshot every `interval` seconds, enabling metrics. Set the returned Event to stop."""
+    enable()
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            logging.getLogger(__name__).log(level, "metrics %s", json.dumps(snapshot()))
+    threading.Thread(target=run, name="metrics-log", daemon=True).start()
+    return stopped
@@ -0,0 +1,142 @@
+import os
+import pickle
+import logging
+import struct
+import threading
+from collections import deque
+
+# Every record of a segment file is its pickle length (8 bytes, little endian) then the pickle
+RECORD_HEADER = struct.Struct("<Q")
+
+class MemorySink:
+    """
+    Keeps the results of a measurement in memory, only the last `keep` ones if it is given,
+    everything otherwise (the historical behaviour of Measurement.results).
+    """
+    def __init__(self, keep=None):
+        if keep is not None and keep < 1:
+            raise ValueError(f"keep must be at least 1, got {keep}")
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=keep)
+
+    def append(self, results):
+        with self.lock:
+            self.recent.append(results)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.recent))
+
+    def __len__(self):
+        return len(self.recent)
+
+    def __getitem__(self, index):
+        with self.lock:
+            return list(self.recent)[index]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def close(self):
+        pass
+
+class SpillSink(MemorySink):
+    """
+    Keeps the last `keep` results in memory and appends the older ones to the segment file
+    `path`, which only grows: memory stays bounded however long the run, and every result can
+    still be read back in arrival order by iterating over the sink.
+
+        sink = SpillSink("run_1.results", keep=100)
+        measurement.configure(schedule, parameters, result_callback, result_sink=sink)
+        ...
+        for results in sink:
+            ...
+    """
+    def __init__(self, path, keep=100):
+        super(SpillSink, self).__init__(keep)
+        self.path = path
+        self.spilled, valid_bytes = self._scan()
+        self.writer = open(path, "ab")
+        # Drop a record that was interrupted half way, later ones would be unreadable after it
+        self.writer.truncate(valid_bytes)
+
+    def _scan(self):
+        records = valid_bytes = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as segment:
+                while True:
+                    header = segment.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    size, = RECORD_HEADER.unpack(header)
+                    if len(segment.read(size)) < size:
+                        break
+                    records += 1
+                    valid_bytes += RECORD_HEADER.size + size
+        return records, valid_bytes
+
+    def append(self, results):
+        with self.lock:
+            if self.writer.closed:
+                # A result that was in flight when the measurement stopped
+                logging.warning(f"Dropping results appended to {self.path} after it was closed")
+                return
+            if len(self.recent) == self.keep:
+                self._spill(self.recent[0])
+            self.recent.append(results)
+
+    def _spill(self, results):
+        record = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer.write(RECORD_HEADER.pack(len(record)))
+        self.writer.write(record)
+        self.writer.flush()
+        self.spilled += 1
+
+    def __iter__(self):
+        with self.lock:
+            recent = list(self.recent)
+        yield from read_segment(self.path)
+        yield from recent
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+class DiscardSink:
+    """Keeps nothing: results only exist in the result callback."""
+    def append(self, results):
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def __repr__(self):
+        return "[]"
+
+    def close(self):
+        pass
+
+def read_segment(path):
+    """Yield the results spilled to a segment file, in order. A truncated last record is ignored."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as segment:
+        while True:
+            header = segment.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            size, = RECORD_HEADER.unpack(header)
+            record = segment.read(size)
+            if len(record) < size:
+                return
+            yield pickle.loads(record)
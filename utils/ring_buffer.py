@@ -0,0 +1,81 @@
+import numpy as np
+
+class RingBuffer:
+    """
+    Fixed-capacity FIFO backed by a numpy array: append is O(1) and, once full, every append
+    overwrites the oldest value, so memory stays constant however long the run.
+    """
+    def __init__(self, capacity, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        self.capacity = capacity
+        self.data = np.empty(capacity, dtype=dtype)
+        self.end = 0  # next write position
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.end] = value
+        self.end = (self.end + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def last(self, n=None):
+        """The last n values (all if None) in insertion order, as a new array. O(n)."""
+        n = self.count if n is None else min(n, self.count)
+        start = self.end - n
+        if start >= 0:
+            return self.data[start:self.end].copy()
+        return np.concatenate((self.data[start:], self.data[:self.end]))
+
+    def clear(self):
+        self.end = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+class MinMaxDecimator:
+    """
+    Keeps a long history at reduced resolution: every `factor` samples collapse into one block
+    holding their first time, minimum and maximum, stored in ring buffers of `capacity` blocks.
+    Plotting the minimum and the maximum of each block keeps the spikes that averaging would hide.
+    """
+    def __init__(self, factor, capacity):
+        self.factor = factor
+        self.times = RingBuffer(capacity)
+        self.minimums = RingBuffer(capacity)
+        self.maximums = RingBuffer(capacity)
+        self.clear()
+
+    def append(self, time, value):
+        if self.pending == 0:
+            self.block_time = time
+            self.block_min = value
+            self.block_max = value
+        else:
+            self.block_min = min(self.block_min, value)
+            self.block_max = max(self.block_max, value)
+        self.pending += 1
+        if self.pending == self.factor:
+            self.times.append(self.block_time)
+            self.minimums.append(self.block_min)
+            self.maximums.append(self.block_max)
+            self.pending = 0
+
+    def envelope(self):
+        """
+        Returns:
+            tuple: times and values, each block contributing its minimum then its maximum.
+        """
+        times = np.repeat(self.times.last(), 2)
+        values = np.empty(len(times))
+        values[0::2] = self.minimums.last()
+        values[1::2] = self.maximums.last()
+        return times, values
+
+    def clear(self):
+        self.times.clear()
+        self.minimums.clear()
+        self.maximums.clear()
+        self.pending = 0
+        self.block_time = self.block_min = self.block_max = None
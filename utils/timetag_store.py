@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import pickle
+import shutil
+import logging
+import tempfile
+import threading
+from collections.abc import Mapping
+import numpy as np
+
+INDEX_FILE = "index.jsonl"
+
+class TimetagStore(Mapping):
+    """
+    On-disk {channel: {wrt: ndarray}} store, a replacement for pickling the whole data_store.
+
+    Every channel is one contiguous array file per dtype that only grows, and index.jsonl gets one
+    line per appended (channel, wrt) chunk with its file, dtype, offset and length. Reads memory-map
+    the channel file, so store[channel][wrt] only pages in the WR seconds that are actually used:
+
+        store = TimetagStore("run_1")
+        store.append_result({2: {1488640.0: timestamps}})
+        histo, peak = calculate_coincidences(store[2][1488640.0], store[3][1488640.0])
+
+    A chunk appended twice for the same (channel, wrt) replaces the previous one in the index.
+    A channel whose dtype changes between seconds (int64 one second, float64 the next) gets a
+    second file for the new dtype; every chunk is read back with the dtype it was appended with.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = {}  # channel -> {wrt: (dtype, offset, length)}
+        self.files = {}  # (channel, dtype) -> file name
+        self.sizes = {}  # (channel, dtype) -> items written
+        self.maps = {}  # (channel, dtype) -> np.memmap of the channel file, remapped when it has grown
+        self.writers = {}  # (channel, dtype) -> open file
+        valid_bytes = self._load_index()
+        self.index_writer = open(os.path.join(path, INDEX_FILE), "a")
+        # Drop a line that was interrupted half way, the next entry would be appended onto it
+        self.index_writer.truncate(valid_bytes)
+
+    def _load_index(self):
+        """Load the entries of the index, returns the size of its complete lines."""
+        index_path = os.path.join(self.path, INDEX_FILE)
+        valid_bytes = 0
+        if not os.path.exists(index_path):
+            return valid_bytes
+        with open(index_path, "rb") as index:
+            for line in index:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("no end of line")
+                    entry = json.loads(line)
+                except ValueError:
+                    # A write interrupted half way through the last line, the data is not indexed
+                    logging.error(f"Ignoring truncated line of {index_path}")
+                    continue
+                valid_bytes = index.tell()
+                channel = entry["channel"] if entry["channel_kind"] == "str" else int(entry["channel"])
+                dtype = np.dtype(entry["dtype"])
+                self._register(channel, dtype, entry["file"])
+                self.entries[channel][entry["wrt"]] = (dtype, entry["offset"], entry["length"])
+                key = (channel, dtype)
+                self.sizes[key] = max(self.sizes[key], entry["offset"] + entry["length"])
+        return valid_bytes
+
+    def _register(self, channel, dtype, file_name):
+        self.entries.setdefault(channel, {})
+        if (channel, dtype) not in self.files:
+            self.files[(channel, dtype)] = file_name
+            self.sizes[(channel, dtype)] = 0
+
+    def _file_name(self, channel, dtype):
+        kind = "str" if isinstance(channel, str) else "int"
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", str(channel))
+        file_name = f"channel_{kind}_{name}_{dtype.name}.bin"
+        taken = set(self.files.values())
+        suffix = 1
+        while file_name in taken:
+            file_name = f"channel_{kind}_{name}_{dtype.name}_{suffix}.bin"
+            suffix += 1
+        return file_name
+
+    def append(self, channel, wrt, timestamps):
+        """Append the timestamps of one channel for one WR second."""
+        timestamps = np.ascontiguousarray(timestamps)
+        if timestamps.ndim != 1:
+            raise ValueError(f"Timestamps must be 1-d, got shape {timestamps.shape}")
+        if isinstance(channel, np.integer):
+            channel = int(channel)
+        dtype = timestamps.dtype
+        if dtype.hasobject:
+            raise ValueError(f"Cannot store {dtype} timestamps")
+        key = (channel, dtype)
+        with self.lock:
+            if key not in self.files:
+                self._register(channel, dtype, self._file_name(channel, dtype))
+            file_name = self.files[key]
+
+            offset = self.sizes[key]
+            writer = self.writers.get(key)
+            if writer is None:
+                writer = self.writers[key] = open(os.path.join(self.path, file_name), "ab")
+                # Drop data of an append that was interrupted before its index line was written
+                writer.truncate(offset * dtype.itemsize)
+            # Data first, then the index line: the index never points past the data
+            writer.write(timestamps.data)
+            writer.flush()
+            self.sizes[key] = offset + timestamps.size
+            self.entries[channel][float(wrt)] = (dtype, offset, timestamps.size)
+            self.index_writer.write(json.dumps({
+                "channel": str(channel), "channel_kind": "str" if isinstance(channel, str) else "int",
+                "file": file_name, "dtype": dtype.str, "wrt": float(wrt),
+                "offset": offset, "length": timestamps.size
+            }) + "\n")
+            self.index_writer.flush()
+
+    def append_result(self, result):
+        """Append a {channel: {wrt: ndarray}} result."""
+        for channel, chunks in result.items():
+            for wrt in sorted(chunks):
+                self.append(channel, wrt, chunks[wrt])
+
+    def read(self, channel, wrt):
+        """Timestamps of one channel for one WR second, as a read-only memory-mapped view."""
+        with self.lock:
+            dtype, offset, length = self.entries[channel][float(wrt)]
+            key = (channel, dtype)
+            if length == 0:
+                return np.empty(0, dtype=dtype)
+            mapped = self.maps.get(key)
+            if mapped is None or len(mapped) < offset + length:
+                mapped = self.maps[key] = np.memmap(os.path.join(self.path, self.files[key]), dtype=dtype, mode="r",
+                                                    shape=(self.sizes[key],))
+            return mapped[offset:offset + length]
+
+    def wrts(self, channel):
+        return sorted(self.entries[channel])
+
+    def __getitem__(self, channel):
+        if channel not in self.entries:
+            raise KeyError(channel)
+        return ChannelView(self, channel)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers.clear()
+            self.index_writer.close()
+            self.maps.clear()
+
+    @classmethod
+    def from_pickle(cls, pickle_path, path) -> 'TimetagStore':
+        """
+        Convert a data_store.pkl file into a new store at `path`. The store is written next to
+        `path` and only moved there once complete, a failed conversion leaves nothing behind.
+        """
+        if os.path.isdir(path) and os.listdir(path):
+            raise FileExistsError(f"{path} is not empty, not converting {pickle_path} into it")
+        with open(pickle_path, "rb") as file:
+            data_store = pickle.load(file)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        partial_path = tempfile.mkdtemp(prefix=f".{os.path.basename(os.path.abspath(path))}.", dir=parent)
+        try:
+            store = cls(partial_path)
+            try:
+                store.append_result(data_store)
+            finally:
+                store.close()
+            os.replace(partial_path, path)
+        except BaseException:
+            shutil.rmtree(partial_path, ignore_errors=True)
+            raise
+        return cls(path)
+
+class ChannelView(Mapping):
+    """{wrt: timestamps} of one channel of a TimetagStore, read lazily."""
+    def __init__(self, store, channel):
+        self.store = store
+        self.channel = channel
+
+    def __getitem__(self, wrt):
+        try:
+            return self.store.read(self.channel, wrt)
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(wrt)
+
+    def __contains__(self, wrt):
+        try:
+            return float(wrt) in self.store.entries[self.channel]
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return iter(self.store.wrts(self.channel))
+
+    def __len__(self):
+        return len(self.store.entries[self.channel])